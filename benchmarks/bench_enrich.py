@@ -0,0 +1,91 @@
+"""
+Enricher 三种字段映射的吞吐量
+
+用法(在项目根目录，需要 res/china.xdb): python benchmarks/bench_enrich.py [每页文档数] [页数]
+接口配置和 cacti 数据随机生成到临时目录，IPv6 不查 MySQL。
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from nettraffic_analyzer.config_cache import JsonFileCache
+from nettraffic_analyzer.enrich import Enricher, SFLOW, IPBANDWIDTH, IPBW
+from nettraffic_analyzer.resolver import Resolver
+
+HOST_COUNT = 200
+INTERFACE_COUNT = 20
+
+
+def random_ip():
+    return "%d.%d.%d.%d" % tuple(random.randrange(256) for _ in range(4))
+
+
+def write_config(tmp_dir):
+    config_data = []
+    cacti_data = []
+    for h in range(HOST_COUNT):
+        for i in range(INTERFACE_COUNT):
+            graph_id = h * INTERFACE_COUNT + i
+            config_data.append({
+                'host_ip': f"10.{h >> 8}.{h & 0xFF}.1", 'interface': str(i), 'agent_ip': random_ip(),
+                'host_name': f"host-{h}", 'node': f"node-{h % 10}", 'costumer': f"customer-{i}",
+                'switch': f"sw-{h}", 'flow_direction': "入站" if i % 2 else "出站",
+                'relation_cacti_graph_id': str(graph_id),
+            })
+            cacti_data.append({'local_graph_id': str(graph_id), 'traffic_in_max': i, 'traffic_out_max': h})
+    config_path = os.path.join(tmp_dir, "config_data.json")
+    cacti_path = os.path.join(tmp_dir, "sflow_cacti_data.json")
+    with open(config_path, "w") as f:
+        json.dump(config_data, f)
+    with open(cacti_path, "w") as f:
+        json.dump(cacti_data, f)
+    return config_path, cacti_path
+
+
+def make_hits(count, ipv6_ratio=0.05):
+    # 实际流量中地址大量重复
+    pool = [random_ip() for _ in range(count // 5)]
+    hits = []
+    for k in range(count):
+        h = random.randrange(HOST_COUNT)
+        src_ip = random.choice(pool)
+        dst_ip = random.choice(pool) if random.random() >= ipv6_ratio else f"2408:8000::{k % 500:x}"
+        hits.append({"_index": "bench", "_id": str(k), "_source": {
+            "@timestamp": "2025-01-01T00:00:00.000Z", "event_timestamp": "2025-01-01T00:00:00.000Z",
+            "host": {"ip": f"10.{h >> 8}.{h & 0xFF}.1"}, "source_id_index": str(random.randrange(INTERFACE_COUNT)),
+            "src_ip": src_ip, "dst_ip": dst_ip, "in_src": src_ip, "in_dst": dst_ip, "source_ip": src_ip,
+        }})
+    return hits
+
+
+def main():
+    page_size = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    pages = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    random.seed(0)
+    resolver = Resolver()
+    resolver.ipv6_mysql_fallback = False
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_path, cacti_path = write_config(tmp_dir)
+        resolver.config_data_cache = JsonFileCache(config_path, resolver.config_data_cache.builders)
+        resolver.sflow_cacti_cache = JsonFileCache(cacti_path, resolver.sflow_cacti_cache.builders)
+        batches = [make_hits(page_size) for _ in range(pages)]
+        for schema in (SFLOW, IPBANDWIDTH, IPBW):
+            enricher = Enricher(resolver, schema)
+            # 预热: 接口模板和各级缓存
+            enricher.bulk_actions(batches[0])
+            count = 0
+            start = time.perf_counter()
+            for hits in batches:
+                count += len(enricher.bulk_actions(hits))
+            elapsed = time.perf_counter() - start
+            total = page_size * pages
+            print(f"{schema.name:<12} {elapsed:8.3f}s  {total / elapsed:12,.0f} doc/s  {count} 条更新")
+
+
+if __name__ == "__main__":
+    main()
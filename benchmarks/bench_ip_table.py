@@ -0,0 +1,66 @@
+"""
+/24 直接索引表 vs XdbSearcher.search 查询性能对比
+
+用法: python benchmarks/bench_ip_table.py [res/china.xdb] [res/china.xdb.tbl] [查询次数]
+索引表不存在时先生成到临时目录。
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from nettraffic_analyzer.ip_table import IpTable, build_table
+from nettraffic_analyzer.xdbSearcher import XdbSearcher
+
+
+def bench(name, func, ips):
+    start = time.perf_counter()
+    results = func(ips)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<28} {elapsed:8.3f}s  {len(ips) / elapsed:12,.0f} ip/s")
+    return results
+
+
+def table_search(table, searcher, ip):
+    region_id = table.lookup(ip)
+    if region_id == table.fallback:
+        return searcher.search(ip)
+    return table.region_string(region_id)
+
+
+def run(db_path, table_path, count):
+    random.seed(0)
+    ips = [random.getrandbits(32) for _ in range(count)]
+    searcher = XdbSearcher(contentBuff=XdbSearcher.loadContentFromFile(dbfile=db_path))
+    table = IpTable(table_path)
+
+    expected = bench("XdbSearcher.search", lambda batch: [searcher.search(ip) for ip in batch], ips)
+    results = bench("/24 table + fallback", lambda batch: [table_search(table, searcher, ip) for ip in batch], ips)
+    assert results == expected
+    fallback = sum(1 for ip in ips if table.lookup(ip) == table.fallback)
+    print(f"回退到 xdb 的比例: {fallback / len(ips):.2%}")
+
+    table.close()
+    searcher.close()
+
+
+def main():
+    db_path = sys.argv[1] if len(sys.argv) > 1 else "res/china.xdb"
+    table_path = sys.argv[2] if len(sys.argv) > 2 else "res/china.xdb.tbl"
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 200000
+    if os.path.exists(table_path):
+        run(db_path, table_path, count)
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        table_path = os.path.join(tmp_dir, "china.xdb.tbl")
+        start = time.perf_counter()
+        build_table(db_path, table_path)
+        print(f"{'build table':<28} {time.perf_counter() - start:8.3f}s")
+        run(db_path, table_path, count)
+
+
+if __name__ == "__main__":
+    main()
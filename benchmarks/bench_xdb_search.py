@@ -0,0 +1,57 @@
+"""
+XdbSearcher 查询性能对比：逐字节探测的二分查找 vs 预解码段索引
+
+用法: python benchmarks/bench_xdb_search.py [res/china.xdb] [查询次数]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from nettraffic_analyzer.xdbSearcher import XdbSearcher
+
+
+def bench(name, func, ips):
+    start = time.perf_counter()
+    results = func(ips)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<28} {elapsed:8.3f}s  {len(ips) / elapsed:12,.0f} ip/s")
+    return results
+
+
+def main():
+    db_path = sys.argv[1] if len(sys.argv) > 1 else "res/china.xdb"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    random.seed(0)
+    ips = [random.getrandbits(32) for _ in range(count)]
+    cb = XdbSearcher.loadContentFromFile(dbfile=db_path)
+
+    probing = XdbSearcher(contentBuff=cb)
+    expected = bench("byte probing search", lambda batch: [probing.search(ip) for ip in batch], ips)
+
+    indexed = XdbSearcher(contentBuff=cb)
+    start = time.perf_counter()
+    indexed.loadSegmentIndex()
+    print(f"{'segment index decode':<28} {time.perf_counter() - start:8.3f}s")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_file = os.path.join(tmp_dir, "china.xdb.seg")
+        XdbSearcher(contentBuff=cb).loadSegmentIndex(cacheFile=cache_file)
+        cached = XdbSearcher(contentBuff=cb)
+        start = time.perf_counter()
+        cached.loadSegmentIndex(cacheFile=cache_file)
+        print(f"{'segment index sidecar load':<28} {time.perf_counter() - start:8.3f}s")
+
+    results = bench("segment index bisect", lambda batch: [indexed.search(ip) for ip in batch], ips)
+    assert results == expected
+    results = bench("segment index searchMany", indexed.searchMany, ips)
+    assert results == expected
+
+    for searcher in (probing, indexed, cached):
+        searcher.close()
+
+
+if __name__ == "__main__":
+    main()
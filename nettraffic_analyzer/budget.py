@@ -0,0 +1,106 @@
+"""
+取数与写入之间的在途预算
+
+已取回、还没有写入确认的文档数(和估算字节数)达到上限时，取数线程阻塞在 acquire，
+直到写入完成后 release 腾出预算。
+RequestLimiter 限制所有调用方合计同时发送的请求数。
+"""
+import threading
+import time
+
+
+class InFlightBudget:
+    """
+    :param max_docs: 在途文档数上限，0 表示不限
+    :param max_bytes: 在途字节数上限，0 表示不限
+    """
+
+    def __init__(self, max_docs=50000, max_bytes=0):
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.condition = threading.Condition()
+        self.docs = 0
+        self.bytes = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def full(self, docs, size):
+        # 没有在途文档时总是放行，单页超过上限也不会卡住
+        if not self.docs:
+            return False
+        return bool(self.max_docs and self.docs + docs > self.max_docs
+                    or self.max_bytes and self.bytes + size > self.max_bytes)
+
+    def acquire(self, docs, size=0):
+        with self.condition:
+            if self.full(docs, size):
+                self.waits += 1
+                start = time.monotonic()
+                while self.full(docs, size):
+                    self.condition.wait()
+                self.wait_seconds += time.monotonic() - start
+            self.docs += docs
+            self.bytes += size
+
+    def release(self, docs, size=0):
+        with self.condition:
+            self.docs -= docs
+            self.bytes -= size
+            self.condition.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """
+        :return: 在途文档是否在 timeout 秒内全部完成
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.docs, timeout)
+
+    def stats(self):
+        """
+        :return: 在途文档数、字节数，因预算用完而等待的次数和总时长
+        """
+        with self.condition:
+            return {
+                'docs': self.docs,
+                'bytes': self.bytes,
+                'max_docs': self.max_docs,
+                'max_bytes': self.max_bytes,
+                'waits': self.waits,
+                'wait_seconds': round(self.wait_seconds, 3),
+            }
+
+
+class RequestLimiter:
+    """
+    多个线程共享的并发请求数上限，上限可以在运行时调整
+
+    :param limit: 同时进行的请求数上限
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, count):
+        """
+        至少有一个空位时返回，最多占用 count 个
+
+        :return: 实际占用的个数
+        """
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            count = max(1, min(count, self.limit - self.active))
+            self.active += count
+            return count
+
+    def release(self, count):
+        with self.condition:
+            self.active -= count
+            self.condition.notify_all()
+
+    def resize(self, limit):
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
@@ -0,0 +1,237 @@
+"""
+批量写入
+
+按请求体字节数分块，多个 bulk 请求并发发送，所有 write 调用合计的并发数按单个请求的耗时增减；
+只重试被拒绝(429)或服务端出错(5xx)的条目，退避时间带随机抖动；
+重试用尽或不可重试的条目写入本地死信文件(bulk API 的 NDJSON 格式)，可以用 replay 重新写入。
+
+重放死信: python -m nettraffic_analyzer.bulk res/dead_letter.ndjson
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+from elasticsearch import ApiError, Elasticsearch, SerializationError, TransportError, helpers
+
+from nettraffic_analyzer.budget import RequestLimiter
+
+logger = logging.getLogger(__name__)
+
+
+def is_retry_status(status):
+    # 被拒绝(429)或服务端错误(5xx)可以重试，单条结果和整个请求出错用同一规则
+    return status is not None and (status == 429 or status >= 500)
+
+
+def dumps(data):
+    # 与 elasticsearch 客户端默认的序列化方式一致
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+class BulkWriter:
+    """
+    :param es: Elasticsearch 客户端
+    :param chunk_bytes: 单个 bulk 请求体的最大字节数
+    :param threads: 初始的同时发送的 bulk 请求数，多个线程同时调用 write 时合计不超过它
+    :param max_threads: threads 调整的上限
+    :param target_latency: 单个 bulk 请求的期望耗时(秒)，低于它时加一个并发，超过两倍或有条目被拒绝时减半
+    :param max_retries: 被拒绝条目的最大重试次数
+    :param initial_backoff: 第一次重试前的最长等待(秒)，之后每次加倍
+    :param max_backoff: 单次重试前的最长等待(秒)
+    :param dead_letter_path: 死信文件路径
+    """
+
+    def __init__(self, es, chunk_bytes=5 * 1024 * 1024, threads=4, max_threads=16, target_latency=2.0,
+                 max_retries=5, initial_backoff=0.5, max_backoff=30, dead_letter_path="res/dead_letter.ndjson"):
+        self.es = es
+        self.chunk_bytes = chunk_bytes
+        self.threads = threads
+        self.max_threads = max(threads, max_threads)
+        self.limiter = RequestLimiter(threads)
+        self.target_latency = target_latency
+        # 单个 bulk 请求耗时的指数移动平均
+        self.latency = None
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.dead_letter_path = dead_letter_path
+        self.lock = threading.Lock()
+        self.docs = 0
+        self.bytes = 0
+        self.sent = 0
+        self.rejected = 0
+        self.dead_letters = 0
+        # 上次 stats() 时的 (时间, 文档数, 字节数, 发送条数, 拒绝条数)
+        self.window = (time.time(), 0, 0, 0, 0)
+
+    def write(self, actions):
+        """
+        :param actions: helpers.bulk 格式的操作
+        :return: (成功条数, 写入死信的条数)
+        :raise: 重试用尽后仍然连接不上 ES 时抛出，调用方不应推进游标
+        """
+        # 按 (索引, id) 对应结果；同一文档的多个部分更新合并成一个
+        pending = {}
+        for action in actions:
+            header, body = helpers.expand_action(action)
+            op_type, meta = next(iter(header.items()))
+            key = (meta.get('_index'), meta.get('_id'))
+            previous = pending.get(key)
+            if op_type == 'update' and previous is not None and 'update' in previous[0] \
+                    and 'doc' in previous[1] and 'doc' in body:
+                body = {**previous[1], **body, 'doc': {**previous[1]['doc'], **body['doc']}}
+            pending[key] = (header, body)
+        pending = {key: (header, dumps(body) if body is not None else None)
+                   for key, (header, body) in pending.items()}
+        # 请求体按 UTF-8 编码后的字节数计算
+        sizes = {key: len(body.encode()) if body is not None else 0 for key, (_, body) in pending.items()}
+        succeeded = 0
+        failed = []
+        attempt = 0
+        while pending:
+            retry = {}
+            size = sum(sizes[key] for key in pending)
+            chunks = math.ceil(size / self.chunk_bytes) or 1
+            threads = self.limiter.acquire(min(self.threads, chunks))
+            start = time.time()
+            # 结果与发送的条目顺序一致，按顺序对应；通过别名写入时结果里的 _index 是实际索引
+            keys = list(pending)
+            try:
+                for key, (ok, item) in zip(keys, helpers.parallel_bulk(
+                        self.es, list(pending.values()), thread_count=threads, chunk_size=len(pending),
+                        max_chunk_bytes=self.chunk_bytes, expand_action_callback=lambda entry: entry,
+                        raise_on_error=False, raise_on_exception=False)):
+                    result = next(iter(item.values()))
+                    entry = pending.pop(key)
+                    rejected = is_retry_status(result.get('status'))
+                    self.count(sizes[key], ok, rejected)
+                    if ok:
+                        succeeded += 1
+                    elif rejected and attempt < self.max_retries:
+                        retry[key] = entry
+                    else:
+                        failed.append((entry, result.get('error')))
+            except (TransportError, ApiError) as e:
+                # 连接错误、超时、429/5xx: 没有收到结果的条目整体重试，其它错误直接抛出
+                if not self.is_retryable(e) or attempt >= self.max_retries:
+                    self.dead_letter(failed)
+                    raise
+                logger.warning(f"bulk 请求出错，{len(pending)} 个记录稍后重试: {e}")
+            else:
+                # 请求按 threads 个一批并发，估算单个请求的耗时
+                waves = math.ceil(chunks / threads)
+                self.adapt((time.time() - start) / waves, bool(retry))
+                # 没有收到结果的条目同样计入重试次数
+                if pending and attempt >= self.max_retries:
+                    failed += [(entry, "没有收到 bulk 结果") for entry in pending.values()]
+                    pending = {}
+            finally:
+                self.limiter.release(threads)
+            retry.update(pending)
+            pending = retry
+            if pending:
+                attempt += 1
+                time.sleep(random.uniform(0, min(self.max_backoff, self.initial_backoff * 2 ** (attempt - 1))))
+        self.dead_letter(failed)
+        return succeeded, len(failed)
+
+    @staticmethod
+    def is_retryable(error):
+        if isinstance(error, ApiError):
+            return is_retry_status(error.status_code)
+        return not isinstance(error, SerializationError)
+
+    def adapt(self, latency, rejected):
+        with self.lock:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            if rejected or self.latency > 2 * self.target_latency:
+                self.threads = max(1, self.threads // 2)
+            elif self.latency < self.target_latency and self.threads < self.max_threads:
+                self.threads += 1
+            self.limiter.resize(self.threads)
+
+    def count(self, size, ok, rejected):
+        with self.lock:
+            self.sent += 1
+            if rejected:
+                self.rejected += 1
+            if ok:
+                self.docs += 1
+                self.bytes += size
+
+    def dead_letter(self, failed):
+        if not failed:
+            return
+        with self.lock:
+            with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                for (header, body), _ in failed:
+                    f.write(dumps(header) + "\n")
+                    if body is not None:
+                        f.write(body + "\n")
+            self.dead_letters += len(failed)
+        logger.error(f"{len(failed)} 个记录写入失败，已记录到 {self.dead_letter_path}，首个错误: {failed[0][1]}")
+
+    def replay(self, path=None):
+        """
+        重新写入死信文件，仍然失败的条目写入新的死信文件
+
+        :return: (成功条数, 仍然失败的条数)
+        """
+        path = path or self.dead_letter_path
+        replay_path = f"{path}.{os.getpid()}.replay"
+        os.replace(path, replay_path)
+        actions = []
+        with open(replay_path, "r", encoding="utf-8") as f:
+            lines = iter(f)
+            for line in lines:
+                header = json.loads(line)
+                op_type, meta = next(iter(header.items()))
+                action = {"_op_type": op_type, **meta}
+                if op_type != "delete":
+                    action.update(json.loads(next(lines)))
+                actions.append(action)
+        result = self.write(actions)
+        os.remove(replay_path)
+        return result
+
+    def stats(self):
+        """
+        :return: 累计条数和自上次调用以来的 docs/s、bytes/s、拒绝率
+        """
+        now = time.time()
+        with self.lock:
+            since, docs, size, sent, rejected = self.window
+            self.window = (now, self.docs, self.bytes, self.sent, self.rejected)
+            elapsed = max(now - since, 1e-6)
+            window_sent = self.sent - sent
+            return {
+                'docs': self.docs,
+                'bytes': self.bytes,
+                'rejected': self.rejected,
+                'dead_letters': self.dead_letters,
+                'docs_per_second': round((self.docs - docs) / elapsed, 1),
+                'bytes_per_second': round((self.bytes - size) / elapsed, 1),
+                'rejection_rate': round((self.rejected - rejected) / window_sent, 4) if window_sent else 0.0,
+                'threads': self.threads,
+                'active_requests': self.limiter.active,
+                'latency': round(self.latency, 3) if self.latency is not None else None,
+            }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="重新写入 bulk 死信文件")
+    arg_parser.add_argument("path", nargs="?", default="res/dead_letter.ndjson")
+    args = arg_parser.parse_args()
+    es = Elasticsearch(["http://localhost:9200"], basic_auth=("nettraffic_analyzer", "nettraffic_analyzer"),
+                       http_compress=True)
+    succeeded, failed = BulkWriter(es).replay(args.path)
+    print(f"已重新写入 {succeeded} 个记录，{failed} 个仍然失败")
+
+
+if __name__ == "__main__":
+    main()
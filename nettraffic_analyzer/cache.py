@@ -0,0 +1,241 @@
+"""
+线程安全的 LRU + TTL 缓存、区间缓存和最近处理过的 id 集合
+"""
+import math
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MASK64 = (1 << 64) - 1
+
+
+class TtlCache:
+    """
+    超过 max_size 时淘汰最久未使用的条目，条目过期后视为不存在
+
+    :param max_size: 最大条目数
+    :param ttl: 默认有效期(秒)，None 或 0 表示不过期
+    """
+
+    def __init__(self, max_size=100000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self.data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self.lock:
+            self.data[key] = (value, expires_at)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        """
+        :return: 条目数、命中/未命中/淘汰/过期次数和命中率
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class IntervalCache:
+    """
+    [起始, 结束] -> 值 的区间缓存，区间之间互不重叠，超过 max_size 时淘汰最久未使用的区间
+
+    :param max_size: 最大区间数
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        # 有序的区间起点，用于二分定位
+        self.starts = []
+        # 起点 -> (终点, 值)，按使用顺序排列
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        """
+        :return: 包含 key 的区间对应的值
+        """
+        with self.lock:
+            i = bisect_right(self.starts, key) - 1
+            if i >= 0:
+                start = self.starts[i]
+                end, value = self.data[start]
+                if key <= end:
+                    self.data.move_to_end(start)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def set(self, start, end, value):
+        with self.lock:
+            if start not in self.data:
+                insort(self.starts, start)
+            self.data[start] = (end, value)
+            self.data.move_to_end(start)
+            while len(self.data) > self.max_size:
+                evicted, _ = self.data.popitem(last=False)
+                del self.starts[bisect_left(self.starts, evicted)]
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.starts.clear()
+            self.data.clear()
+
+    def stats(self):
+        """
+        :return: 区间数、命中/未命中/淘汰次数和命中率
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class RecentIds:
+    """
+    最近处理过的 id 的布隆过滤器，分两代轮换: 当前一代写满 capacity 个后成为上一代，查询时两代都检查
+    判断为不存在时一定不存在，判断为存在时有 error_rate 的误判概率
+
+    :param capacity: 每一代容纳的 id 数
+    :param error_rate: 一代写满时的误判率
+    """
+
+    def __init__(self, capacity=1000000, error_rate=1e-6):
+        self.capacity = capacity
+        self.bits = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        # 没有 numpy 时用 bytearray 逐个计算，结果相同但更慢
+        size = (self.bits + 7) // 8
+        self.current = np.zeros(size, dtype=np.uint8) if np is not None else bytearray(size)
+        self.previous = None
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def positions(self, keys):
+        if np is None:
+            return [self.key_positions(key) for key in keys]
+        # 只在进程内使用，可以直接用内置 hash；第二个哈希由 splitmix64 混合得到，第 i 个位置为 h1 + i * h2
+        h1 = np.fromiter((hash(key) for key in keys), dtype=np.int64, count=len(keys)).view(np.uint64)
+        h2 = h1 + np.uint64(0x9E3779B97F4A7C15)
+        h2 = (h2 ^ (h2 >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        h2 = (h2 ^ (h2 >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        h2 = (h2 ^ (h2 >> np.uint64(31))) | np.uint64(1)
+        steps = np.arange(self.hashes, dtype=np.uint64)
+        return (h1[:, None] + steps * h2[:, None]) % np.uint64(self.bits)
+
+    def key_positions(self, key):
+        h1 = hash(key) & MASK64
+        h2 = (h1 + 0x9E3779B97F4A7C15) & MASK64
+        h2 = ((h2 ^ (h2 >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+        h2 = ((h2 ^ (h2 >> 27)) * 0x94D049BB133111EB) & MASK64
+        h2 = (h2 ^ (h2 >> 31)) | 1
+        return [((h1 + i * h2) & MASK64) % self.bits for i in range(self.hashes)]
+
+    def add_many(self, keys):
+        if not keys:
+            return
+        positions = self.positions(keys)
+        with self.lock:
+            if self.count + len(keys) > self.capacity:
+                self.previous = self.current
+                self.current = np.zeros_like(self.previous) if np is not None else bytearray(len(self.previous))
+                self.count = 0
+            self.count += len(keys)
+            if np is None:
+                for key_positions in positions:
+                    for position in key_positions:
+                        self.current[position >> 3] |= 1 << (position & 7)
+                return
+            positions = positions.ravel()
+            np.bitwise_or.at(self.current, (positions >> np.uint64(3)).astype(np.intp),
+                             np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+
+    def contains_many(self, keys):
+        """
+        :return: 与 keys 对应的 bool 列表
+        """
+        if not keys:
+            return []
+        positions = self.positions(keys)
+        if np is None:
+            with self.lock:
+                return [any(all(bits[p >> 3] & (1 << (p & 7)) for p in key_positions)
+                            for bits in (self.current, self.previous) if bits is not None)
+                        for key_positions in positions]
+        offsets = (positions >> np.uint64(3)).astype(np.intp)
+        masks = np.left_shift(1, positions & np.uint64(7)).astype(np.uint8)
+        with self.lock:
+            found = ((self.current[offsets] & masks) != 0).all(axis=1)
+            if self.previous is not None:
+                found |= ((self.previous[offsets] & masks) != 0).all(axis=1)
+        return found.tolist()
+
+    def clear(self):
+        with self.lock:
+            self.current[:] = bytes(len(self.current)) if np is None else 0
+            self.previous = None
+            self.count = 0
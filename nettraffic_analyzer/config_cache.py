@@ -0,0 +1,96 @@
+"""
+JSON 配置文件的内存快照
+
+文件的大小和修改时间没变时直接返回上次构建的查找表；变化时比较内容哈希，
+内容确实变化才重新解析并构建查找表，构建完成后整体替换，读取方始终拿到完整的一版。
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class JsonFileCache:
+    """
+    :param path: JSON 文件路径
+    :param builders: {名称: 函数(解析后的数据) -> 查找表}
+    """
+
+    def __init__(self, path, builders):
+        self.path = path
+        self.builders = builders
+        self.lock = threading.Lock()
+        # (文件签名, 内容哈希, {名称: 查找表})，整体替换
+        self.snapshot = (None, None, {})
+        self.last_error = None
+
+    def get(self, name):
+        """
+        :return: 最新的查找表，文件不可用且从未加载成功时为空字典
+        """
+        self.refresh()
+        return self.snapshot[2].get(name, {})
+
+    @staticmethod
+    def file_signature(path):
+        stat = os.stat(path)
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def refresh(self):
+        try:
+            signature = self.file_signature(self.path)
+        except OSError as e:
+            self.report_error(f"读取 {self.path} 失败: {e}")
+            return
+        if signature == self.snapshot[0]:
+            return
+        with self.lock:
+            if signature == self.snapshot[0]:
+                return
+            try:
+                with open(self.path, 'rb') as f:
+                    content = f.read()
+            except OSError as e:
+                self.report_error(f"读取 {self.path} 失败: {e}")
+                return
+            self.load(content, signature, self.path)
+
+    def update(self, content, source):
+        """
+        用其它来源(如 HTTP 接口)的内容更新快照
+
+        :param content: JSON 原始字节
+        :param source: 日志中显示的来源
+        """
+        with self.lock:
+            self.load(content, self.snapshot[0], source)
+
+    def load(self, content, signature, source):
+        # 调用方持有 self.lock
+        digest = hashlib.blake2b(content, digest_size=16).digest()
+        if digest == self.snapshot[1]:
+            # 只是文件被重新写入，内容没有变化
+            self.snapshot = (signature, digest, self.snapshot[2])
+            return
+        start = time.time()
+        try:
+            data = json.loads(content)
+            tables = {name: build(data) for name, build in self.builders.items()}
+        except Exception as e:
+            # 保留上一版，直到文件再次变化
+            self.report_error(f"解析 {source} 失败，继续使用上一版: {e}")
+            self.snapshot = (signature, self.snapshot[1], self.snapshot[2])
+            return
+        self.snapshot = (signature, digest, tables)
+        self.last_error = None
+        logger.warning(f"已加载 {source}，{len(data)} 条记录，耗时：{round(time.time() - start, 3)}s")
+
+    def report_error(self, message):
+        # 同一个错误只记录一次，避免每个批次刷屏
+        if message != self.last_error:
+            self.last_error = message
+            logger.error(message)
@@ -0,0 +1,147 @@
+"""
+增量处理的游标
+
+游标位置为 (时间戳, 索引)。每页取回后登记它的位置，批量写入确认后才标记完成，
+只有某页之前的所有页都已完成，游标才推进到该页并落盘；进程重启后从最后确认的位置继续。
+
+只保存时间戳不保存排序值: _doc/_shard_doc 的顺序在两次查询之间不稳定，不能作为续查的依据。
+重启后从该时间戳(含)重新查询，内存中的去重集合是空的，时间戳与游标相同的文档会再写一次；
+写入的是由原字段算出的部分更新，重复写入结果相同。
+"""
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class Cursor:
+    """
+    :param path: 游标文件路径
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.condition = threading.Condition()
+        self.next_seq = 0
+        # 序号 -> [位置, 状态]，按登记顺序排列，状态 None 为处理中，True 为已写入，False 为失败
+        self.pending = OrderedDict()
+        self.committed = None
+        # 与位置一起保存的其它字段
+        self.extra = {}
+        # 有页写入失败，游标停在失败页之前，需要 rewind 后重新拉取
+        self.stalled = False
+
+    def load(self, default):
+        """
+        :param default: 游标文件不存在时的位置
+        :return: 最后确认的位置
+        """
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            # 旧版本游标文件里的 sort 不再使用
+            data.pop("sort", None)
+            self.committed = (data.pop("last_checked_time"), data.pop("index", None))
+            self.extra = data
+        except FileNotFoundError:
+            self.committed = default
+        return self.committed
+
+    def save(self, position):
+        timestamp, index = position
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"last_checked_time": timestamp, "index": index, **self.extra}, f)
+        os.replace(tmp_path, self.path)
+
+    def reset(self, position, **extra):
+        """
+        丢弃登记，从 position 重新开始
+        """
+        with self.condition:
+            self.pending.clear()
+            self.stalled = False
+            self.extra = extra
+            self.save(position)
+            self.committed = position
+
+    def remove(self):
+        with self.condition:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.committed = None
+            self.extra = {}
+
+    def advance(self, position):
+        """
+        推进到不需要写入的位置(如切换索引)，仍然排在已登记的页之后
+        """
+        self.ack(self.begin(position))
+
+    def begin(self, position):
+        """
+        登记一页
+
+        :param position: 这一页处理完成后游标可以推进到的位置，None 表示不推进
+        :return: 序号，写入确认后传给 ack
+        """
+        with self.condition:
+            seq = self.next_seq
+            self.next_seq += 1
+            self.pending[seq] = [position, None]
+            return seq
+
+    def ack(self, seq, ok=True):
+        """
+        :param ok: 为 False 时游标停在这一页之前，直到 rewind
+        """
+        with self.condition:
+            entry = self.pending.get(seq)
+            if entry is None:
+                return
+            entry[1] = ok
+            if not ok:
+                self.stalled = True
+            position = None
+            while self.pending:
+                first_seq, (first_position, state) = next(iter(self.pending.items()))
+                if state is not True:
+                    break
+                del self.pending[first_seq]
+                if first_position is not None:
+                    position = first_position
+            if position is not None:
+                try:
+                    self.save(position)
+                    self.committed = position
+                except OSError as e:
+                    logger.error(f"保存游标 {self.path} 失败: {e}")
+            self.condition.notify_all()
+
+    def wait(self):
+        """
+        等待处理中的页全部结束
+
+        :return: 是否有页写入失败
+        """
+        with self.condition:
+            while any(state is None for _, state in self.pending.values()):
+                self.condition.wait()
+            return self.stalled
+
+    def rewind(self):
+        """
+        等待处理中的页全部结束，丢弃失败页之后的登记
+
+        :return: 最后确认的位置，从这里重新拉取
+        """
+        with self.condition:
+            self.wait()
+            self.pending.clear()
+            self.stalled = False
+            return self.committed
@@ -0,0 +1,432 @@
+"""
+列式归属地补全：按声明的字段映射处理一页ES文档，直接生成 Bulk API 更新操作
+
+    1. 抽取: 每条文档只读一次 _source，需要的字段按列存放
+    2. 解析: 整页IP地址去重后批量查询，按键关联接口模板或主机配置
+    3. 输出: 按输出映射逐列生成字段值，最后拼成更新文档
+
+可选的多进程模式见 bulk_actions_parallel: 抽取和IPv6查询在主进程完成，只把需要的列和IPv6结果发给子进程，
+子进程各自用 mmap 打开同一份 china.xdb(开启进程池时默认开启 xdb_mmap，共享页缓存)并生成接口模板，只返回更新字段。
+"""
+import logging
+from types import MappingProxyType
+
+from nettraffic_analyzer.resolver import Resolver, flow_isp_types
+
+logger = logging.getLogger(__name__)
+
+# 没有配置的主机
+EMPTY_CONFIG = MappingProxyType({})
+
+
+class Lookup:
+    """
+    一列IP地址的查询方式
+
+    :param column: IP 所在列
+    :param rewrite: IPv4 结果是否经过 Resolver.rewrite_ipinfo
+    :param family_of: 按哪一列是否为 IPv4 决定查询方式，默认为本列
+    :param ipv6: family_of 列不是 IPv4 时按 IPv6 查询，否则该行不生成更新
+    :param role: 开启 IPv6 延迟解析时登记的角色 ('src' / 'dst')
+    """
+
+    def __init__(self, column, rewrite=True, family_of=None, ipv6=False, role=None):
+        self.column = column
+        self.rewrite = rewrite
+        self.family_of = family_of or column
+        self.ipv6 = ipv6
+        self.role = role
+
+
+class Schema:
+    """
+    一种索引的字段映射
+
+    :param name: 名称，用于日志
+    :param index_prefix: 按天滚动的索引名前缀
+    :param timestamp_field: 增量查询使用的时间字段
+    :param source_fields: {列名: _source 中以 "." 分隔的字段路径}
+    :param required: 值不能为空的列
+    :param lookups: Lookup 列表，同一地址以整页中第一次出现时的查询方式为准
+    :param join: 'interface' 按 join_key 关联 EnrichmentTemplate，没有模板的行不生成更新
+                 'host' 按 join_key 关联 config_data.json 中的主机配置，没有配置时取默认值
+    :param join_key: 组成关联键的列，以 "_" 连接
+    :param output: [(输出字段, 取值方式, 参数)]，取值方式:
+                   config    关联到的配置字段
+                   info      IP 列的 Region
+                   region    IP 列的 "省份城市"
+                   region_full  IP 列的 "IP 省份城市"
+                   isp       IP 列去掉"中国"的运营商
+                   ip_type   IP 列为 IPv4 时是 "ipv4"，否则 "ipv6"
+                   flow_isp_type  agent_ip 到该 IP 列的流量类型
+    """
+
+    def __init__(self, name, index_prefix, timestamp_field, source_fields, required, lookups, join, join_key,
+                 output):
+        self.name = name
+        self.index_prefix = index_prefix
+        self.timestamp_field = timestamp_field
+        self.source_fields = {column: tuple(path.split(".")) for column, path in source_fields.items()}
+        # 查询时只取回这些 _source 字段
+        self.source_includes = sorted({timestamp_field, *source_fields.values()})
+        self.required = tuple(required)
+        self.lookups = tuple(lookups)
+        self.join = join
+        self.join_key = tuple(join_key)
+        self.output = tuple(output)
+
+
+SFLOW = Schema(
+    name="sflow",
+    index_prefix="sflow",
+    timestamp_field="@timestamp",
+    source_fields={
+        'host_ip': "host.ip",
+        'src_ip': "src_ip",
+        'dst_ip': "dst_ip",
+        'ifindex': "source_id_index",
+    },
+    required=('src_ip', 'dst_ip', 'host_ip'),
+    lookups=(
+        Lookup('src_ip', family_of='dst_ip', ipv6=True, role='src'),
+        Lookup('dst_ip', family_of='dst_ip', ipv6=True, role='dst'),
+    ),
+    join='interface',
+    join_key=('host_ip', 'ifindex'),
+    output=(
+        ("flow_isp_type", 'flow_isp_type', 'dst_ip'),
+        ("flow_isp_info", 'info', 'dst_ip'),
+        ("flow_isp_info_src", 'info', 'src_ip'),
+        ("customer", 'config', 'customer'),
+        ("node", 'config', 'node'),
+        ("ipType", 'ip_type', 'dst_ip'),
+        ("sw_interface", 'config', 'sw_interface'),
+        ("dst_ip_region", 'region_full', 'dst_ip'),
+        ("src_ip_region", 'region_full', 'src_ip'),
+        ("flow_direction", 'config', 'flow_direction'),
+        ("sum_traffic_in_max", 'config', 'sum_traffic_in_max'),
+        ("sum_traffic_out_max", 'config', 'sum_traffic_out_max'),
+    ),
+)
+
+IPBANDWIDTH = Schema(
+    name="ipbandwidth",
+    index_prefix="ipbandwidth",
+    timestamp_field="@timestamp",
+    source_fields={
+        'host_ip': "host.ip",
+        'local_ip': "in_dst",
+        'remote_ip': "in_src",
+    },
+    required=('local_ip', 'remote_ip', 'host_ip'),
+    lookups=(
+        Lookup('local_ip', rewrite=False),
+        Lookup('remote_ip', family_of='local_ip'),
+    ),
+    join='host',
+    join_key=('host_ip',),
+    output=(
+        ("host_name", 'config', 'host_name'),
+        ("node", 'config', 'node'),
+        ("customer", 'config', 'costumer'),
+        ("interface", 'config', 'interface'),
+        ("local_ip_region", 'region', 'local_ip'),
+        ("remote_ip_region", 'region', 'remote_ip'),
+        ("local_ip_isp", 'isp', 'local_ip'),
+        ("remote_ip_isp", 'isp', 'remote_ip'),
+        ("local_ip_region_full", 'region_full', 'local_ip'),
+        ("remote_ip_region_full", 'region_full', 'remote_ip'),
+        ("local_ip_info", 'info', 'local_ip'),
+        ("remote_ip_info", 'info', 'remote_ip'),
+    ),
+)
+
+IPBW = Schema(
+    name="ipbw",
+    index_prefix="ipbw",
+    timestamp_field="event_timestamp",
+    source_fields={
+        'host_ip': "host.ip",
+        'local_ip': "source_ip",
+    },
+    required=('local_ip', 'host_ip'),
+    lookups=(
+        Lookup('local_ip', rewrite=False),
+    ),
+    join='host',
+    join_key=('host_ip',),
+    output=(
+        ("host_name", 'config', 'host_name'),
+        ("node", 'config', 'node'),
+        ("customer", 'config', 'costumer'),
+        ("interface", 'config', 'interface'),
+        ("local_ip_region", 'region', 'local_ip'),
+        ("local_ip_info", 'info', 'local_ip'),
+    ),
+)
+
+
+SCHEMAS = {schema.name: schema for schema in (SFLOW, IPBANDWIDTH, IPBW)}
+
+
+class Enricher:
+    """
+    按 Schema 补全一页文档
+
+    :param resolver: Resolver
+    :param schema: SFLOW / IPBANDWIDTH / IPBW
+    """
+
+    def __init__(self, resolver, schema):
+        self.resolver = resolver
+        self.schema = schema
+
+    def bulk_actions(self, hits, deferred=None):
+        """
+        :param hits: search 返回的 hits
+        :param deferred: 开启IPv6延迟解析时，暂记为"未知"的地址及其文档追加到该列表，
+                         调用方写入ES后交给 Resolver.defer_ipv6_updates
+        :return: Bulk API 更新操作
+        """
+        return self.emit(*self.enrich_columns(self.extract(hits), deferred))
+
+    def bulk_actions_parallel(self, pool, shards, hits, deferred=None, min_shard_size=1000):
+        """
+        与 bulk_actions 相同，但把整页按行切分给进程池处理
+
+        :param pool: 以 init_worker 为 initializer 的 ProcessPoolExecutor
+        :param shards: 最多切成几份
+        :param min_shard_size: 每份最少的行数，整页不足时在本进程处理
+        """
+        columns = self.extract(hits)
+        count = len(columns['_id'])
+        size = max(-(-count // shards), min_shard_size)
+        if count <= size:
+            return self.emit(*self.enrich_columns(columns, deferred))
+        # 没有接口模板的行不发给子进程，也不查它们的IPv6
+        configs, agents = self.join(self.resolver.db, columns)
+        rows = [i for i, config in enumerate(configs) if config is not None]
+        columns, _, _ = self.select(rows, columns, configs, agents)
+        count = len(rows)
+        shard_columns = [{name: values[i:i + size] for name, values in columns.items()} for i in range(0, count, size)]
+        # IPv6 只在主进程查询，共用主进程的查询缓存(含查不到的短期缓存)和延迟解析
+        ip_longs = {}
+        shard_ipv6 = [self.collect(shard, ip_longs)[1] for shard in shard_columns]
+        ipv6_regions, provisional = self.resolve_ipv6(set().union(*shard_ipv6), deferred)
+        futures = [
+            pool.submit(enrich_shard, self.schema.name, shard, deferred is not None,
+                        ({ip: ipv6_regions[ip] for ip in ips}, provisional & ips.keys() if provisional else None))
+            for shard, ips in zip(shard_columns, shard_ipv6)
+        ]
+        indices, ids, rows = [], [], []
+        for future in futures:
+            (shard_indices, shard_ids, shard_rows), shard_deferred = future.result()
+            indices += shard_indices
+            ids += shard_ids
+            rows += shard_rows
+            if deferred is not None:
+                deferred += shard_deferred
+        return self.emit(indices, ids, rows)
+
+    def enrich_columns(self, columns, deferred=None, ipv6=None):
+        """
+        :param columns: extract 的结果
+        :param ipv6: 主进程已查好的 ({IPv6 地址: Region}, 暂记为"未知"的地址集合或 None)，见 resolve
+        :return: (_index 列, _id 列, 各行按 schema.output 顺序的字段值)
+        """
+        schema = self.schema
+        # 整个批次使用同一版本的 xdb，热更新不影响进行中的批次
+        db = self.resolver.db
+        configs, agents = self.join(db, columns)
+        rows = [i for i, config in enumerate(configs) if config is not None]
+        columns, configs, agents = self.select(rows, columns, configs, agents)
+        ip_longs = {}
+        regions, provisional = self.resolve(db, columns, ip_longs, deferred, ipv6)
+        # IPv4 查询方式下不是合法 IPv4 的地址解析不到
+        lookup_columns = [columns[lookup.column] for lookup in schema.lookups]
+        rows = [i for i in range(len(configs)) if all(ips[i] in regions for ips in lookup_columns)]
+        columns, configs, agents = self.select(rows, columns, configs, agents)
+        if not rows:
+            return [], [], []
+
+        if provisional:
+            for lookup in schema.lookups:
+                if lookup.role is None:
+                    continue
+                for ip, index, doc_id, agent_ip_info in zip(
+                        columns[lookup.column], columns['_index'], columns['_id'], agents):
+                    if ip in provisional:
+                        deferred.append((ip, index, doc_id, lookup.role, agent_ip_info))
+
+        values = [
+            self.output_column(kind, arg, columns, configs, agents, regions, ip_longs)
+            for _, kind, arg in schema.output
+        ]
+        return columns['_index'], columns['_id'], list(zip(*values))
+
+    def emit(self, indices, ids, rows):
+        names = [name for name, _, _ in self.schema.output]
+        return [
+            {"_op_type": "update", "_index": index, "_id": doc_id, "doc": dict(zip(names, row))}
+            for index, doc_id, row in zip(indices, ids, rows)
+        ]
+
+    def extract(self, hits):
+        """
+        :return: {列名: 值列表}，另有 _index / _id 两列，必填列为空的文档不在其中
+        """
+        schema = self.schema
+        fields = list(schema.source_fields.items())
+        columns = {name: [] for name in ('_index', '_id', *schema.source_fields)}
+        appends = [(columns[name].append, path) for name, path in fields]
+        required = [list(schema.source_fields).index(name) for name in schema.required]
+        append_index = columns['_index'].append
+        append_id = columns['_id'].append
+        for hit in hits:
+            source = hit['_source']
+            row = []
+            for _, path in fields:
+                value = source
+                for key in path:
+                    value = value.get(key) if isinstance(value, dict) else None
+                row.append(value)
+            if not all(row[i] for i in required):
+                continue
+            append_index(hit['_index'])
+            append_id(hit['_id'])
+            for (append, _), value in zip(appends, row):
+                append(value)
+        return columns
+
+    def join(self, db, columns):
+        """
+        :return: (每行的配置, 每行的 agent_ip Region 或 None)，没有模板的行配置为 None
+        """
+        keys = ["_".join(str(value) for value in key) for key in zip(*(columns[name] for name in self.schema.join_key))]
+        if self.schema.join == 'interface':
+            templates = self.resolver.enrichment_templates(db)
+            joined = [templates.get(key) for key in keys]
+            configs = [template.fields if template is not None else None for template in joined]
+            agents = [template.agent_ip_info if template is not None else None for template in joined]
+            return configs, agents
+        host_configs = self.resolver.read_config_data_v2()
+        return [host_configs.get(key, EMPTY_CONFIG) for key in keys], None
+
+    @staticmethod
+    def select(rows, columns, configs, agents):
+        """
+        只保留 rows 中的行
+        """
+        if len(rows) == len(configs):
+            return columns, configs, agents
+        columns = {name: [values[i] for i in rows] for name, values in columns.items()}
+        configs = [configs[i] for i in rows]
+        if agents is not None:
+            agents = [agents[i] for i in rows]
+        return columns, configs, agents
+
+    def resolve(self, db, columns, ip_longs, deferred=None, ipv6=None):
+        """
+        整页地址去重后批量查询
+
+        :param ip_longs: 本批次 {地址: IPv4 整数或 None} 的缓存，每个地址只解析一次
+        :param ipv6: 不为 None 时直接使用其中的IPv6结果，不再查询
+        :return: ({地址: Region}, 暂记为"未知"的 IPv6 地址集合或 None)
+        """
+        pending, ipv6_pending = self.collect(columns, ip_longs)
+        regions = {}
+        self.resolver.prefetch_ipv4_info(db, pending, regions, ip_longs)
+        if ipv6 is None:
+            ipv6 = self.resolve_ipv6(ipv6_pending, deferred)
+        ipv6_regions, provisional = ipv6
+        regions.update(ipv6_regions)
+        return regions, provisional
+
+    def collect(self, columns, ip_longs):
+        """
+        :return: ({IPv4 地址: 是否 rewrite}, {IPv6 地址: None})，同一地址以第一次出现时的查询方式为准
+        """
+        parse_ipv4 = self.resolver.parse_ipv4
+        lookups = [(columns[lookup.column], columns[lookup.family_of], lookup) for lookup in self.schema.lookups]
+        pending = {}
+        ipv6_pending = {}
+        for i in range(len(columns['_id'])):
+            for ips, families, lookup in lookups:
+                ip = ips[i]
+                if ip in pending or ip in ipv6_pending:
+                    continue
+                if parse_ipv4(families[i], ip_longs) is not None:
+                    pending[ip] = lookup.rewrite
+                elif lookup.ipv6:
+                    ipv6_pending[ip] = None
+        return pending, ipv6_pending
+
+    def resolve_ipv6(self, ips, deferred=None):
+        """
+        :return: ({地址: Region}, 暂记为"未知"的地址集合或 None)
+        """
+        regions = {}
+        if not ips:
+            return regions, None
+        provisional = set() if self.resolver.ipv6_deferred and deferred is not None else None
+        self.resolver.prefetch_ipv6_info(list(ips), regions, provisional)
+        return regions, provisional
+
+    def output_column(self, kind, arg, columns, configs, agents, regions, ip_longs):
+        if kind == 'config':
+            return [config.get(arg, '未知') for config in configs]
+        if kind == 'ip_type':
+            parse_ipv4 = self.resolver.parse_ipv4
+            return ["ipv6" if parse_ipv4(ip, ip_longs) is None else "ipv4" for ip in columns[arg]]
+
+        infos = [regions[ip] for ip in columns[arg]]
+        if kind == 'info':
+            return infos
+        if kind == 'isp':
+            return [info.isp_name for info in infos]
+        if kind == 'flow_isp_type':
+            return flow_isp_types.classify_many(agents, infos)
+        if kind in ('region', 'region_full'):
+            # 每个地址只格式化一次
+            strings = {}
+            result = []
+            for ip, info in zip(columns[arg], infos):
+                value = strings.get(ip)
+                if value is None:
+                    value = f"{info.get('province', '')}{info.get('city', '')}"
+                    if kind == 'region_full':
+                        value = f"{ip} {value}"
+                    strings[ip] = value
+                result.append(value)
+            return result
+        raise ValueError(f"{self.schema.name}: 未知的取值方式 {kind}")
+
+
+# 子进程内的 Resolver 和按 schema 名称创建的 Enricher
+_worker_resolver = None
+_worker_enrichers = {}
+
+
+def init_worker():
+    """
+    进程池 initializer: 子进程有自己的 Resolver，xdb 以 mmap 打开，接口模板在子进程内生成
+    不启动后台线程，热更新、配置轮询和IPv6查询都由主进程负责
+    """
+    global _worker_resolver
+    _worker_resolver = Resolver(background=False)
+
+
+def enrich_shard(schema_name, columns, defer, ipv6):
+    """
+    子进程内处理一份列数据
+
+    :param ipv6: 主进程查好的这一份的IPv6结果，见 Enricher.resolve
+
+    :return: (enrich_columns 的结果, 延迟解析登记列表或 None)
+    """
+    _worker_resolver.poll_xdb()
+    enricher = _worker_enrichers.get(schema_name)
+    if enricher is None:
+        enricher = _worker_enrichers[schema_name] = Enricher(_worker_resolver, SCHEMAS[schema_name])
+    deferred = [] if defer else None
+    return enricher.enrich_columns(columns, deferred, ipv6), deferred
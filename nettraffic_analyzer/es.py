@@ -4,116 +4,495 @@
 # Copyright (c) <yuanzigsa@gmail.com>
 import json
 import logging
-from elasticsearch import Elasticsearch, helpers
+import queue
+import threading
+from elasticsearch import Elasticsearch
 from datetime import datetime, timedelta, timezone
 import time
 from dateutil import parser
 from nettraffic_analyzer.resolver import Resolver
-from concurrent.futures import ThreadPoolExecutor
+from nettraffic_analyzer.budget import InFlightBudget
+from nettraffic_analyzer.bulk import BulkWriter, dumps
+from nettraffic_analyzer.cache import RecentIds
+from nettraffic_analyzer.cursor import Cursor
+from nettraffic_analyzer.scheduler import PollScheduler
+from nettraffic_analyzer.enrich import Enricher, SFLOW, IPBANDWIDTH, IPBW, init_worker
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+
+# 查询响应只保留处理需要的部分
+SEARCH_FILTER_PATH = "hits.hits._index,hits.hits._id,hits.hits._source,hits.hits.sort"
+# point-in-time 查询还要保留 ES 返回的最新 pit_id
+PIT_SEARCH_FILTER_PATH = SEARCH_FILTER_PATH + ",pit_id"
 
 
 class Es:
     """
     sflow 数据处理
     """
+    schema = SFLOW
+
     def __init__(self, max_workers=30):
         self.logger = logging.getLogger(__name__)
-        # 配置 Elasticsearch 客户端
-        self.es = Elasticsearch(["http://localhost:9200"], basic_auth=("nettraffic_analyzer", "nettraffic_analyzer"))
+        # 配置 Elasticsearch 客户端，请求和响应使用 gzip 压缩
+        self.es = Elasticsearch(["http://localhost:9200"], basic_auth=("nettraffic_analyzer", "nettraffic_analyzer"),
+                                http_compress=True)
         if self.es.ping():
             self.logger.info("成功连接到 Elasticsearch")
         else:
             self.logger.error("无法连接到 Elasticsearch")
             exit(1)
         self.resolver = Resolver()
-        self.check_interval = 0.5
+        self.resolver.deferred_update_handler = self.apply_deferred_updates
+        self.enricher = Enricher(self.resolver, self.schema)
         self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            with open("config/config.json", "r") as f:
+                config = json.load(f)
+        except FileNotFoundError:
+            config = {}
+        # 轮询间隔和每页条数按积压与查询耗时在配置范围内调整
+        self.scheduler = PollScheduler(
+            min_interval=config.get('poll_min_interval', 0.5),
+            max_interval=config.get('poll_max_interval', 10),
+            max_backoff=config.get('poll_max_backoff', 60),
+            min_page_size=config.get('page_size_min', 1000),
+            max_page_size=config.get('page_size_max', 10000),
+            target_latency=config.get('fetch_target_latency', 1.0),
+            lag_target=config.get('lag_target', 30),
+        )
+        self.stats_interval = config.get('stats_interval', 60)
+        # 按字节分块并发写入，只重试被拒绝的条目，最终失败的写入死信文件
+        self.bulk_writer = BulkWriter(
+            self.es,
+            chunk_bytes=config.get('bulk_chunk_bytes', 5 * 1024 * 1024),
+            threads=config.get('bulk_threads', 4),
+            max_threads=config.get('bulk_max_threads', 16),
+            target_latency=config.get('bulk_target_latency', 2.0),
+            max_retries=config.get('bulk_max_retries', 5),
+            initial_backoff=config.get('bulk_initial_backoff', 0.5),
+            max_backoff=config.get('bulk_max_backoff', 30),
+            dead_letter_path=config.get('dead_letter_path', "res/dead_letter.ndjson"),
+        )
+        # 多进程补全: 每页按行切给 enrich_processes 个子进程，0 表示在线程池内处理
+        self.enrich_processes = config.get('enrich_processes', 0)
+        self.process_pool = None
+        if self.enrich_processes:
+            # spawn 启动，不继承主进程的线程和锁
+            self.process_pool = ProcessPoolExecutor(
+                max_workers=self.enrich_processes, mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker)
         self.file_path = "res/last_checked_time.json"
+        # 游标在批量写入确认后才推进
+        self.cursor = Cursor(self.file_path)
+        # 查询从游标时间戳(含)开始，与上一轮重叠的部分按 id 跳过已经交给写入的文档
+        self.processed_ids = RecentIds(config.get('processed_ids_capacity', 1000000),
+                                       config.get('processed_ids_error_rate', 1e-6))
+        # 写入失败、需要重新处理的文档
+        self.retry_ids = set()
+        # 已经拉取到的最大时间戳，不晚于它的文档属于重叠部分
+        self.fetched_until = None
+        # 落后超过 scan_slice_lag 秒时，在 point-in-time 上切成 scan_slices 片并发拉取
+        self.scan_slices = config.get('scan_slices', 1)
+        self.scan_slice_lag = config.get('scan_slice_lag', 300)
+        self.pit_keep_alive = config.get('pit_keep_alive', "1m")
+        # 已取回、还没写入确认的文档数(和估算字节数)上限，用完时暂停取数
+        self.budget = InFlightBudget(config.get('max_inflight_docs', 50000), config.get('max_inflight_bytes', 0))
+        # stop() 之后不再取新的页，shutdown() 等在途的页写完
+        self.stopping = threading.Event()
+        self.shutdown_timeout = config.get('shutdown_timeout', 60)
+        # 积压通道: 落后超过 backlog_lag 秒且跨了天时，历史索引交给独立线程用更多切片和更大的页拉取，
+        # 实时通道从当天索引开始
+        self.backlog_lag = config.get('backlog_lag', 3600)
+        self.backlog_slices = config.get('backlog_slices', 4)
+        self.backlog_page_size = config.get('backlog_page_size', 10000)
+        self.backlog_cursor = Cursor("res/backlog_cursor.json")
+        self.backlog_thread = None
+        # 流式处理: 每页取回后立即交给补全、写入阶段，内存中最多 pipeline_pages 页，0 表示整批取完再处理
+        self.pipeline_pages = config.get('pipeline_pages', 0)
+        if self.pipeline_pages:
+            self.start_pipeline(config.get('pipeline_enrich_threads', 2), config.get('pipeline_write_threads', 2))
+
+    @staticmethod
+    def time_range(timestamp_field, last_time, until=None):
+        bounds = {"gte": last_time.isoformat()}
+        if until is not None:
+            bounds["lt"] = until.isoformat()
+        return {"range": {timestamp_field: bounds}}
+
+    def iter_new_documents(self, es_client, index, timestamp_field, last_time, batch_size=None, until=None):
+        """
+        使用 search_after 逐页获取时间戳不早于 last_time 的新记录，调用方取下一页时才发出查询
+
+        :param batch_size: 每页条数，默认每页按 scheduler 的当前值
+        :param until: 只取早于该时间的记录
+        """
+        search_after = None
+        fetched = 0
+        while True:
+            query = {
+                "query": self.time_range(timestamp_field, last_time, until),
+                "sort": [
+                    {timestamp_field: "asc"},
+                    "_doc"
+                ],
+                "size": batch_size or self.scheduler.page_size,
+                "_source": self.schema.source_includes
+            }
 
+            # 添加 search_after 参数
+            if search_after:
+                query["search_after"] = search_after
 
+            start = time.time()
+            try:
+                response = es_client.search(index=index, body=query, filter_path=SEARCH_FILTER_PATH)
+            except Exception as e:
+                self.scheduler.observe_error(e)
+                raise
+            # filter_path 过滤后，没有命中时响应中不含 hits
+            hits = response.get('hits', {}).get('hits', [])
+            self.scheduler.observe_page(len(hits), time.time() - start)
 
-    def get_new_documents(self, es_client, index, timestamp_field, last_time):
+            if not hits:
+                return
+
+            fetched += len(hits)
+            # 可选：添加进度日志
+            self.logger.info(f"已获取 {fetched} 条记录")
+            yield hits
+
+            # 获取最后一个文档的排序值作为下一次查询的 search_after
+            search_after = hits[-1]['sort']
+
+    def iter_sliced_documents(self, index, timestamp_field, last_time, slices, batch_size=None, until=None):
         """
-        使用 search_after 获取时间戳大于 last_time 的所有新记录
+        在 point-in-time 上把查询切成 slices 片，每片一个线程各自用 search_after 翻页
+
+        :return: 逐页产出 (hits, 游标位置)。位置的时间戳是所有分片都已越过的水位：
+                 未结束分片各自最后一条记录时间戳的最小值，全部结束时为最大时间戳；
+                 还有分片没有取到记录时位置为 None。
+                 每片查询前先占用页槽，产出的每一页都占着一个页槽，见 consume_pages
         """
+        # 各分片每次查询都换用 ES 最近一次返回的 pit_id，结束时关闭最新的
+        pit_id = [self.es.open_point_in_time(index=index, keep_alive=self.pit_keep_alive)['id']]
+        pages = queue.Queue(maxsize=slices)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def fetch_slice(slice_id):
+            body = {
+                "pit": {"id": pit_id[0], "keep_alive": self.pit_keep_alive},
+                "slice": {"id": slice_id, "max": slices},
+                "query": self.time_range(timestamp_field, last_time, until),
+                "sort": [{timestamp_field: "asc"}, {"_shard_doc": "asc"}],
+                "_source": self.schema.source_includes,
+            }
+            try:
+                while self.acquire_page_slot(stop):
+                    body["size"] = batch_size or self.scheduler.page_size
+                    body["pit"]["id"] = pit_id[0]
+                    start = time.time()
+                    try:
+                        response = self.es.search(body=body, filter_path=PIT_SEARCH_FILTER_PATH)
+                    except Exception as e:
+                        self.release_page_slot()
+                        self.scheduler.observe_error(e)
+                        raise
+                    pit_id[0] = response.get('pit_id', pit_id[0])
+                    hits = response.get('hits', {}).get('hits', [])
+                    self.scheduler.observe_page(len(hits), time.time() - start)
+                    if not hits:
+                        self.release_page_slot()
+                        break
+                    if not put((slice_id, hits)):
+                        self.release_page_slot()
+                        return
+                    body["search_after"] = hits[-1]['sort']
+                put((slice_id, None))
+            except Exception as e:
+                put((slice_id, e))
+
+        threads = [
+            threading.Thread(target=fetch_slice, args=(slice_id,), name=f"scan-slice-{slice_id}", daemon=True)
+            for slice_id in range(slices)
+        ]
+        for thread in threads:
+            thread.start()
+        progress = [None] * slices
+        active = set(range(slices))
         try:
-            all_hits = []
-            search_after = None
-            batch_size = 10000
+            while active:
+                slice_id, hits = pages.get()
+                if isinstance(hits, Exception):
+                    raise hits
+                if hits is None:
+                    active.discard(slice_id)
+                    if active:
+                        continue
+                    latest = [value for value in progress if value is not None]
+                    if latest:
+                        self.acquire_page_slot()
+                        yield [], (max(latest), index)
+                    break
+                progress[slice_id] = max(progress[slice_id] or "", max(doc['_source'][timestamp_field] for doc in hits))
+                pending = [progress[i] for i in active]
+                yield hits, None if None in pending else (min(pending), index)
+        finally:
+            stop.set()
+            # 提前结束时释放已取回、还没交出去的页占用的页槽
+            for thread in threads:
+                thread.join()
+            while True:
+                try:
+                    _, hits = pages.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(hits, list):
+                    self.release_page_slot()
+            try:
+                self.es.close_point_in_time(id=pit_id[0])
+            except Exception as e:
+                self.logger.warning(f"关闭 point-in-time 失败: {e}")
 
+    def iter_pages(self, index, timestamp_field, last_time):
+        """
+        :return: 逐页产出 (hits, 游标位置)，落后较多且配置了 scan_slices 时并发切片拉取
+        """
+        if self.scan_slices > 1 and datetime.now(timezone.utc) - last_time > timedelta(seconds=self.scan_slice_lag):
+            self.logger.warning(f"落后于 {last_time.isoformat()}，切成 {self.scan_slices} 片并发拉取")
+            return self.iter_sliced_documents(index, timestamp_field, last_time, self.scan_slices)
+        return self.hold_page_slots(
+            (hits, (hits[-1]['_source'][timestamp_field], hits[-1]['_index']))
+            for hits in self.iter_new_documents(self.es, index, timestamp_field, last_time)
+        )
+
+    def hold_page_slots(self, pages):
+        """
+        取下一页之前先占用一个页槽，产出的每一页都占着一个页槽，见 consume_pages
+        """
+        try:
             while True:
-                query = {
-                    "query": {
-                        "range": {
-                            timestamp_field: {
-                                "gt": last_time.isoformat()
-                            }
-                        }
-                    },
-                    "sort": [
-                        {timestamp_field: "asc"},
-                        "_doc"
-                    ],
-                    "size": batch_size
-                }
-
-                # 添加 search_after 参数
-                if search_after:
-                    query["search_after"] = search_after
-
-                response = es_client.search(index=index, body=query)
-                hits = response['hits']['hits']
+                self.acquire_page_slot()
+                try:
+                    item = next(pages, None)
+                except BaseException:
+                    self.release_page_slot()
+                    raise
+                if item is None:
+                    self.release_page_slot()
+                    return
+                yield item
+        finally:
+            pages.close()
 
-                if not hits:
+    def get_new_documents(self, es_client, index, timestamp_field, last_time):
+        """
+        使用 search_after 获取时间戳不早于 last_time 的所有新记录，出错时抛给 run 的重试，不会被当作没有新记录
+        """
+        all_hits = []
+        if es_client is self.es:
+            for hits, _ in self.iter_pages(index, timestamp_field, last_time):
+                all_hits.extend(hits)
+            return all_hits
+        for hits in self.iter_new_documents(es_client, index, timestamp_field, last_time):
+            all_hits.extend(hits)
+        return all_hits
+
+    def start_pipeline(self, enrich_threads, write_threads):
+        """
+        取数(run 所在线程) -> 补全 -> 写入 三个阶段，各阶段之间用队列连接
+        取下一页之前先占用一个页槽，写入完成后释放，取数在页槽用完时阻塞
+        """
+        self.page_slots = threading.BoundedSemaphore(self.pipeline_pages)
+        self.enrich_queue = queue.Queue()
+        self.write_queue = queue.Queue()
+        for i in range(enrich_threads):
+            threading.Thread(target=self.enrich_stage, name=f"enrich-{i}", daemon=True).start()
+        for i in range(write_threads):
+            threading.Thread(target=self.write_stage, name=f"bulk-{i}", daemon=True).start()
+
+    def stream_new_documents(self, index, timestamp_field, last_time):
+        """
+        流式处理模式下实时通道的一轮查询
+
+        :return: 下一轮查询的起始时间
+        """
+        pages = self.iter_pages(index, timestamp_field, last_time)
+        last_time, fetched_until = self.consume_pages(pages, self.cursor, timestamp_field, last_time,
+                                                      self.fetched_until)
+        self.fetched_until = max(self.fetched_until or "", fetched_until or "") or None
+        return last_time
+
+    def consume_pages(self, pages, cursor, timestamp_field, last_time, overlap_until):
+        """
+        每取回一页就登记到 cursor，然后交给补全、写入，写入确认后游标才推进
+
+        :param pages: 逐页产出 (hits, 游标位置)，每页都已占用一个页槽，写入完成后释放
+        :param overlap_until: 不晚于该时间戳的文档可能已经交给过写入
+        :return: (下一轮查询的起始时间, 取到的最大时间戳)
+        """
+        fetched_until = None
+        held = False
+        try:
+            while not self.stopping.is_set():
+                hits, position = next(pages, (None, None))
+                if hits is None:
                     break
+                held = True
+                if position is not None:
+                    last_time = max(last_time, parser.isoparse(position[0]))
+                if hits:
+                    fetched_until = max(fetched_until or "", *(doc['_source'][timestamp_field] for doc in hits))
+                    hits = self.drop_processed(hits, timestamp_field, overlap_until)
+                if not hits:
+                    cursor.advance(position)
+                    held = False
+                    self.release_page_slot()
+                    continue
+                ticket = self.reserve(hits, cursor, position)
+                held = False
+                self.dispatch_page(hits, ticket)
+            return last_time, fetched_until
+        except Exception:
+            if held:
+                self.release_page_slot()
+            raise
+        finally:
+            pages.close()
+
+    def acquire_page_slot(self, stop=None):
+        """
+        :param stop: 等待页槽时该事件被设置则放弃
+        :return: 是否占用到页槽
+        """
+        if not self.pipeline_pages:
+            return True
+        while not self.page_slots.acquire(timeout=1):
+            if stop is not None and stop.is_set():
+                return False
+        return True
+
+    def release_page_slot(self):
+        if self.pipeline_pages:
+            self.page_slots.release()
+
+    def reserve(self, hits, cursor, position):
+        """
+        占用在途预算(用完时阻塞)并把这一页登记到 cursor
 
-                all_hits.extend(hits)
-                
-                # 获取最后一个文档的排序值作为下一次查询的 search_after
-                search_after = hits[-1]['sort']
+        :return: (Cursor, 序号, 估算字节数)，这一页处理结束后传给 finish_page
+        """
+        size = sum(len(dumps(hit['_source']).encode()) for hit in hits) if self.budget.max_bytes else 0
+        self.budget.acquire(len(hits), size)
+        return cursor, cursor.begin(position), size
 
-                # 可选：添加进度日志
-                self.logger.info(f"已获取 {len(all_hits)} 条记录")
+    def dispatch_page(self, hits, ticket):
+        """
+        :param ticket: reserve 的返回值
+        """
+        if self.pipeline_pages:
+            self.enrich_queue.put((hits, ticket))
+        else:
+            self.executor.submit(self.update_docs, hits, ticket)
 
-            return all_hits
+    def enrich_stage(self):
+        while True:
+            hits, ticket = self.enrich_queue.get()
+            deferred = []
+            actions = self.enrich_page(hits, deferred)
+            self.write_queue.put((actions, deferred, hits, ticket))
 
-        except Exception as e:
-            self.logger.error(f"获取新文档时出错: {e}")
-            return []
+    def write_stage(self):
+        while True:
+            actions, deferred, hits, ticket = self.write_queue.get()
+            ok = False
+            try:
+                start = time.time()
+                self.write_actions(actions, deferred)
+                ok = True
+                self.logger.warning(f"更新完成，耗时：{round(time.time() - start, 2)}s")
+            except Exception as e:
+                self.logger.error(f"写入 {len(actions)} 个记录时出错: {e}")
+            finally:
+                self.finish_page(hits, ticket, ok)
+                self.page_slots.release()
+
+    @staticmethod
+    def document_keys(hits):
+        return [f"{hit['_index']}/{hit['_id']}" for hit in hits]
 
-    def prepare_bulk_update(self, docs):
+    def drop_processed(self, hits, timestamp_field, overlap_until):
+        """
+        去掉重叠部分(时间戳不晚于 overlap_until)中已经交给写入的文档，剩下的登记为已处理
+        """
+        keys = self.document_keys(hits)
+        if overlap_until is not None:
+            overlap = [i for i, hit in enumerate(hits) if hit['_source'][timestamp_field] <= overlap_until]
+            if overlap:
+                seen = self.processed_ids.contains_many([keys[i] for i in overlap])
+                skip = {i for i, found in zip(overlap, seen) if found and keys[i] not in self.retry_ids}
+                if skip:
+                    hits = [hit for i, hit in enumerate(hits) if i not in skip]
+                    keys = [key for i, key in enumerate(keys) if i not in skip]
+        self.processed_ids.add_many(keys)
+        if self.retry_ids:
+            self.retry_ids.difference_update(keys)
+        return hits
+
+    def finish_page(self, hits, ticket, ok):
+        """
+        一页处理结束: 成功时推进游标；写入失败时游标停在这一页之前，这些文档重新拉取时不会被跳过
+        """
+        if not ok:
+            self.retry_ids.update(self.document_keys(hits))
+        cursor, seq, size = ticket
+        cursor.ack(seq, ok)
+        self.budget.release(len(hits), size)
+
+    def prepare_bulk_update(self, docs, deferred=None):
         """
         根据记录中的字段值，准备 Bulk API 更新操作
         """
-        new_docs = self.resolver.rewrite_docs(docs)
-        actions = []
-        for doc in new_docs:
-            source = doc['_source']
-            doc_id = doc['_id']
-            new_field = {
-                "flow_isp_type": source['flow_isp_type'],
-                "flow_isp_info": source['flow_isp_info'],
-                "flow_isp_info_src": source['flow_isp_info_src'],
-                "customer": source['customer'],
-                "node": source['node'],
-                "ipType": source['ipType'],
-                "sw_interface": source['sw_interface'],
-                "dst_ip_region": source['dst_ip_region'],
-                "src_ip_region": source['src_ip_region'],
-                "flow_direction": source['flow_direction'],
-                "sum_traffic_in_max": source['sum_traffic_in_max'],
-                "sum_traffic_out_max": source['sum_traffic_out_max'],
-            }
-            action = {
-                "_op_type": "update",
-                "_index": doc['_index'],
-                "_id": doc_id,
-                "doc": new_field
-            }
-            actions.append(action)
-        return actions
+        if self.process_pool is not None:
+            return self.enricher.bulk_actions_parallel(self.process_pool, self.enrich_processes, docs, deferred)
+        return self.enricher.bulk_actions(docs, deferred)
 
-    def update_docs(self, docs):
+    def enrich_page(self, docs, deferred):
+        """
+        补全一页文档；整页出错时改为逐条补全，补全不了的文档(字段类型异常等)跳过，
+        不让个别文档卡住游标，重新拉取也只会再错一次
+        """
+        try:
+            return self.prepare_bulk_update(docs, deferred)
+        except Exception as e:
+            self.logger.error(f"补全 {len(docs)} 个记录时出错，改为逐条处理: {e}")
+        deferred.clear()
+        bulk_actions = []
+        skipped = []
+        for doc in docs:
+            doc_deferred = []
+            try:
+                bulk_actions += self.enricher.bulk_actions([doc], doc_deferred)
+            except Exception as e:
+                skipped.append((doc, e))
+                continue
+            deferred += doc_deferred
+        if skipped:
+            doc, e = skipped[0]
+            self.logger.error(f"跳过 {len(skipped)} 个无法补全的记录，首个 {doc['_index']}/{doc['_id']}: {e!r}")
+        return bulk_actions
+
+    def update_docs(self, docs, ticket=None):
+        ok = False
         try:
             start = time.time()
 
@@ -121,136 +500,132 @@ class Es:
                 self.logger.warning(f"找到 {len(docs)} 个新记录，正在处理...")
 
                 # 准备更新操作
-                bulk_actions = self.prepare_bulk_update(docs)
+                deferred = []
+                bulk_actions = self.enrich_page(docs, deferred)
 
-                if bulk_actions:
-                    # 执行批量更新
-                    helpers.bulk(self.es, bulk_actions)
-                    self.logger.warning(f"成功更新 {len(bulk_actions)} 个记录。")
-                else:
-                    self.logger.warning("没有需要更新的记录。")
+                self.write_actions(bulk_actions, deferred)
             else:
                 self.logger.warning("没有新记录。")
 
+            ok = True
             self.logger.warning(f"更新完成，耗时：{round(time.time() - start, 2)}s")
         except Exception as e:
             self.logger.error(f"update_docs 运行时发生错误: {e}")
+        finally:
+            if ticket is not None:
+                self.finish_page(docs, ticket, ok)
+
+    def write_actions(self, bulk_actions, deferred):
+        if bulk_actions:
+            # 执行批量更新
+            succeeded, dead_letters = self.bulk_writer.write(bulk_actions)
+            self.logger.warning(f"成功更新 {succeeded} 个记录。")
+            if dead_letters:
+                self.logger.warning(f"{dead_letters} 个记录已写入死信文件 {self.bulk_writer.dead_letter_path}")
+            # 主批次写入后再登记IPv6延迟解析，补充更新不会被主批次覆盖
+            if deferred:
+                self.resolver.defer_ipv6_updates(deferred)
+        else:
+            self.logger.warning("没有需要更新的记录。")
+        self.logger.warning(f"IP缓存统计: {self.resolver.cache_stats()}")
 
-    def save_last_checked_time(self, last_checked_time):
-        with open(self.file_path, "w") as f:
-            json.dump({"last_checked_time": last_checked_time.isoformat()}, f)
+    def apply_deferred_updates(self, updates):
+        """
+        IPv6 延迟解析完成后，对相关文档补发部分更新
+        """
+        actions = [
+            {"_op_type": "update", "_index": index, "_id": doc_id, "doc": fields}
+            for index, doc_id, fields in updates
+        ]
+        succeeded, _ = self.bulk_writer.write(actions)
+        self.logger.warning(f"IPv6 延迟解析补充更新 {succeeded} 个记录。")
 
     def load_last_checked_time(self):
-        try:
-            with open(self.file_path, "r") as f:
-                data = json.load(f)
-                return parser.isoparse(data["last_checked_time"])
-        except FileNotFoundError:
-            return datetime.now(timezone.utc) - timedelta(seconds=1)
+        default = ((datetime.now(timezone.utc) - timedelta(seconds=1)).isoformat(), None)
+        return parser.isoparse(self.cursor.load(default)[0])
 
-    def run(self):
-        timestamp_field = "@timestamp"
-        last_checked_time = self.load_last_checked_time()
-        retry_config = {
-            'max_retries': 3,
-            'initial_delay': 1,  # 初始延迟1秒
-            'max_delay': 30,     # 最大延迟30秒
-            'backoff_factor': 2  # 指数退避因子
-        }
-
-        while True:
-            try:
-                # 使用 UTC 时间
-                index_name = f"sflow-{datetime.now(timezone.utc).strftime('%Y.%m.%d')}"
-                
-                # 使用指数退避的重试机制
-                for attempt in range(retry_config['max_retries']):
-                    try:
-                        # 获取新记录
-                        new_docs = self.get_new_documents(
-                            es_client=self.es,
-                            index=index_name,
-                            timestamp_field=timestamp_field,
-                            last_time=last_checked_time
-                        )
-
-                        if new_docs:
-                            # 更新最后一次检查的时间为最新记录的时间
-                            latest_time_str = max([doc['_source'][timestamp_field] for doc in new_docs])
-                            last_checked_time = parser.isoparse(latest_time_str)
-                            # 将最后检查时间写入文件
-                            self.save_last_checked_time(last_checked_time)
-                            # 提交更新任务到线程池
-                            self.executor.submit(self.update_docs, new_docs)
-                        else:
-                            self.logger.info("没有新的文档需要更新")
-
-                        break  # 成功执行后跳出重试循环
-
-                    except Exception as e:
-                        delay = min(
-                            retry_config['initial_delay'] * (retry_config['backoff_factor'] ** attempt),
-                            retry_config['max_delay']
-                        )
-                        if attempt < retry_config['max_retries'] - 1:
-                            self.logger.warning(f"第 {attempt + 1} 次尝试失败: {e}，{delay} 秒后重试")
-                            time.sleep(delay)
-                        else:
-                            raise
-
-            except Exception as e:
-                self.logger.error(f"NettrafficAnalyzer_for_ELK运行发生错误: {e}")
-
-            time.sleep(self.check_interval)
-
-    def shutdown(self):
-        self.executor.shutdown(wait=True)
+    def index_name(self, moment):
+        return f"{self.schema.index_prefix}-{moment.strftime('%Y.%m.%d')}"
 
+    def next_index(self, index, boundary):
+        """
+        :return: 已存在的、名称在 index 与 boundary 之间的第一个按天滚动的索引，没有时为 None
+        """
+        rows = self.es.cat.indices(index=f"{self.schema.index_prefix}-*", h="index", format="json")
+        names = sorted(row['index'] for row in rows if index < row['index'] < boundary)
+        return names[0] if names else None
 
-class Es_v2(Es):
-    """
-    ipbw agent数据处理
-    """
-    def __init__(self, max_workers=30):
-        super().__init__(max_workers)
-        self.es = Elasticsearch(["http://localhost:9200"], basic_auth=("nettraffic_analyzer", "nettraffic_analyzer"))
+    def start_backlog(self, position, until):
+        """
+        把 position 到 until 之间的历史索引交给积压通道
 
-    def prepare_bulk_update(self, docs):
+        :param position: 积压的起始游标位置
+        :param until: 积压的结束时间(不含)，即实时通道的起点
         """
-        根据记录中的字段值，准备 Bulk API 更新操作
+        self.backlog_cursor.reset(position, until=until.isoformat())
+        self.resume_backlog()
+
+    def resume_backlog(self):
+        if self.backlog_thread is not None and self.backlog_thread.is_alive():
+            return
+        if self.backlog_cursor.load(None) is None:
+            return
+        self.backlog_thread = threading.Thread(target=self.run_backlog, name="backlog", daemon=True)
+        self.backlog_thread.start()
+
+    def run_backlog(self):
         """
-        new_docs = self.resolver.rewrite_docs_v2(docs)
-        actions = []
-        for doc in new_docs:
-            source = doc['_source']
-            doc_id = doc['_id']
-            
-            new_field = {
-                "host_name": source['host_name'],
-                "node": source['node'],
-                "customer": source['customer'],
-                "interface": source['interface'],
-                "local_ip_region": source['local_ip_region'],
-                "remote_ip_region": source['remote_ip_region'],
-                "local_ip_isp": source['local_ip_isp'],
-                "remote_ip_isp": source['remote_ip_isp'],
-                "local_ip_region_full": source['local_ip_region_full'],
-                "remote_ip_region_full": source['remote_ip_region_full'],
-                "local_ip_info": source['local_ip_info'],
-                "remote_ip_info": source['remote_ip_info'],
-            }
-            action = {
-                "_op_type": "update",
-                "_index": doc['_index'],
-                "_id": doc_id,
-                "doc": new_field
-            }
-            actions.append(action)
-        return actions
+        积压通道: 按名称顺序逐个取完早于 until 的历史索引，用 backlog_slices 片并发、每页 backlog_page_size 条
+        """
+        cursor = self.backlog_cursor
+        timestamp_field = self.schema.timestamp_field
+        until = parser.isoparse(cursor.extra['until'])
+        boundary = self.index_name(until)
+        timestamp, index = cursor.committed
+        last_time = parser.isoparse(timestamp)
+        self.logger.warning(f"积压通道: 从 {index} {timestamp} 补到 {until.isoformat()}")
+        fetched_until = None
+        while not self.stopping.is_set():
+            if cursor.stalled:
+                timestamp, index = cursor.rewind()
+                last_time = parser.isoparse(timestamp)
+                self.logger.warning(f"积压通道写入失败，从 {index} {timestamp} 重新拉取")
+            try:
+                if self.backlog_slices > 1:
+                    pages = self.iter_sliced_documents(index, timestamp_field, last_time, self.backlog_slices,
+                                                       self.backlog_page_size, until)
+                else:
+                    pages = self.hold_page_slots(
+                        (hits, (hits[-1]['_source'][timestamp_field], hits[-1]['_index']))
+                        for hits in self.iter_new_documents(self.es, index, timestamp_field, last_time,
+                                                            self.backlog_page_size, until)
+                    )
+                last_time, page_until = self.consume_pages(pages, cursor, timestamp_field, last_time, fetched_until)
+                fetched_until = max(fetched_until or "", page_until or "") or None
+                # 这个索引已经取完，全部写入后再切到下一个
+                if cursor.wait() or self.stopping.is_set():
+                    continue
+                index = self.next_index(index, boundary)
+                if index is None:
+                    break
+                cursor.advance((last_time.isoformat(), index))
+                self.logger.warning(f"积压通道: 开始 {index}")
+            except Exception as e:
+                self.logger.error(f"积压通道运行发生错误: {e}")
+                self.stopping.wait(self.scheduler.interval)
+        else:
+            # 停止时保留游标文件，下次启动继续
+            return
+        cursor.remove()
+        self.logger.warning(f"积压通道: 已补到 {until.isoformat()}")
 
     def run(self):
-        timestamp_field = "@timestamp"
+        timestamp_field = self.schema.timestamp_field
         last_checked_time = self.load_last_checked_time()
+        # 实时通道当前的索引，旧格式的游标没有记录索引时按游标时间所在的那一天
+        index_name = self.cursor.committed[1] or self.index_name(last_checked_time)
+        self.resume_backlog()
+        stats_logged_at = time.time()
         retry_config = {
             'max_retries': 3,
             'initial_delay': 1,  # 初始延迟1秒
@@ -258,14 +633,35 @@ class Es_v2(Es):
             'backoff_factor': 2  # 指数退避因子
         }
 
-        while True:
+        while not self.stopping.is_set():
             try:
+                if self.cursor.stalled:
+                    # 有页写入失败: 等处理中的页结束后从最后确认的位置重新拉取
+                    timestamp, index = self.cursor.rewind()
+                    last_checked_time = parser.isoparse(timestamp)
+                    index_name = index or index_name
+                    self.logger.warning(f"写入失败，从 {index_name} {timestamp} 重新拉取")
                 # 使用 UTC 时间
-                index_name = f"ipbandwidth-{datetime.now(timezone.utc).strftime('%Y.%m.%d')}"
-                
+                now = datetime.now(timezone.utc)
+                live_index = self.index_name(now)
+                if index_name < live_index and (now - last_checked_time).total_seconds() > self.backlog_lag \
+                        and (self.backlog_thread is None or not self.backlog_thread.is_alive()):
+                    # 跨天积压: 历史索引交给积压通道，实时通道从当天零点开始
+                    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+                    self.start_backlog((last_checked_time.isoformat(), index_name), midnight)
+                    last_checked_time = max(last_checked_time, midnight)
+                    index_name = live_index
+                    self.cursor.advance((last_checked_time.isoformat(), index_name))
+                round_start = last_checked_time
+
                 # 使用指数退避的重试机制
                 for attempt in range(retry_config['max_retries']):
                     try:
+                        if self.pipeline_pages:
+                            last_checked_time = self.stream_new_documents(
+                                index_name, timestamp_field, last_checked_time)
+                            break
+
                         # 获取新记录
                         new_docs = self.get_new_documents(
                             es_client=self.es,
@@ -276,13 +672,21 @@ class Es_v2(Es):
 
                         if new_docs:
                             # 更新最后一次检查的时间为最新记录的时间
-                            latest_time_str = max([doc['_source'][timestamp_field] for doc in new_docs])
+                            latest = max(new_docs, key=lambda doc: doc['_source'][timestamp_field])
+                            latest_time_str = latest['_source'][timestamp_field]
                             last_checked_time = parser.isoparse(latest_time_str)
-                            # 将最后检查时间写入文件
-                            self.save_last_checked_time(last_checked_time)
-                            # 提交更新任务到线程池
-                            self.executor.submit(self.update_docs, new_docs)
-                            self.logger.warning(f"找到 {len(new_docs)} 个新记录，正在处理...")
+                            overlap_until = self.fetched_until
+                            self.fetched_until = max(self.fetched_until or "", latest_time_str)
+                            new_docs = self.drop_processed(new_docs, timestamp_field, overlap_until)
+                            # 写入确认后游标才推进到最新记录
+                            position = (latest_time_str, latest['_index'])
+                            if new_docs:
+                                # 提交更新任务到线程池，在途预算用完时在这里等待
+                                self.executor.submit(self.update_docs, new_docs,
+                                                     self.reserve(new_docs, self.cursor, position))
+                            else:
+                                self.cursor.advance(position)
+                                self.logger.info("没有新的文档需要更新")
                         else:
                             self.logger.info("没有新的文档需要更新")
 
@@ -299,100 +703,61 @@ class Es_v2(Es):
                         else:
                             raise
 
+                if self.stopping.is_set():
+                    break
+                progressed = last_checked_time > round_start
+                if not progressed and index_name < live_index:
+                    # 跨天后旧索引已经取完，按名称顺序切到下一个索引
+                    index_name = self.next_index(index_name, live_index) or live_index
+                    self.cursor.advance((last_checked_time.isoformat(), index_name))
+                    self.logger.warning(f"切换到索引 {index_name}")
+                self.scheduler.observe_round(progressed, parser.isoparse(self.cursor.committed[0]))
             except Exception as e:
                 self.logger.error(f"NettrafficAnalyzer_for_ELK运行发生错误: {e}")
 
-            time.sleep(self.check_interval)
-
+            if time.time() - stats_logged_at >= self.stats_interval:
+                stats_logged_at = time.time()
+                self.logger.warning(f"轮询状态: {self.scheduler.stats()}")
+                self.logger.warning(f"写入状态: {self.bulk_writer.stats()}")
+                self.logger.warning(f"在途: {self.budget.stats()}")
+            self.stopping.wait(self.scheduler.interval)
+        self.shutdown()
 
-
-class Es_v3(Es):
-    """
-    ipbw agent数据处理
-    """
-    def __init__(self, max_workers=30):
-        super().__init__(max_workers)
-        self.es = Elasticsearch(["http://localhost:9200"], basic_auth=("nettraffic_analyzer", "nettraffic_analyzer"))
-
-    def prepare_bulk_update(self, docs):
+    def stop(self):
         """
-        根据记录中的字段值，准备 Bulk API 更新操作
+        停止取数，run 退出循环后调用 shutdown；可以在信号处理函数中调用
         """
-        new_docs = self.resolver.rewrite_docs_v3(docs)
-        actions = []
-        for doc in new_docs:
-            source = doc['_source']
-            doc_id = doc['_id']
-            
-            new_field = {
-                "host_name": source['host_name'],
-                "node": source['node'],
-                "customer": source['customer'],
-                "interface": source['interface'],
-                "local_ip_region": source['local_ip_region'],
-                "local_ip_info": source['local_ip_info'],
-            }
-            action = {
-                "_op_type": "update",
-                "_index": doc['_index'],
-                "_id": doc_id,
-                "doc": new_field
-            }
-            actions.append(action)
-        return actions
-
-    def run(self):
-        timestamp_field = "event_timestamp"
-        last_checked_time = self.load_last_checked_time()
-        retry_config = {
-            'max_retries': 3,
-            'initial_delay': 1,  # 初始延迟1秒
-            'max_delay': 30,     # 最大延迟30秒
-            'backoff_factor': 2  # 指数退避因子
-        }
+        self.stopping.set()
 
-        while True:
-            try:
-                # 使用 UTC 时间
-                index_name = f"ipbw-{datetime.now(timezone.utc).strftime('%Y.%m.%d')}"
-                
-                # 使用指数退避的重试机制
-                for attempt in range(retry_config['max_retries']):
-                    try:
-                        # 获取新记录
-                        new_docs = self.get_new_documents(
-                            es_client=self.es,
-                            index=index_name,
-                            timestamp_field=timestamp_field,
-                            last_time=last_checked_time
-                        )
-
-                        if new_docs:
-                            # 更新最后一次检查的时间为最新记录的时间
-                            latest_time_str = max([doc['_source'][timestamp_field] for doc in new_docs])
-                            last_checked_time = parser.isoparse(latest_time_str)
-                            # 将最后检查时间写入文件
-                            self.save_last_checked_time(last_checked_time)
-                            # 提交更新任务到线程池
-                            self.executor.submit(self.update_docs, new_docs)
-                            self.logger.warning(f"找到 {len(new_docs)} 个新记录，正在处理...")
-                        else:
-                            self.logger.info("没有新的文档需要更新")
+    def shutdown(self):
+        """
+        停止取数，等已取回的页写入完成、游标随之推进后，关闭线程池和进程池
+        总共最多等 shutdown_timeout 秒，超时后丢弃排队中的页，重启后从已落盘的游标重新拉取
+        """
+        self.stopping.set()
+        deadline = time.monotonic() + self.shutdown_timeout
+        drained = self.budget.wait_idle(self.shutdown_timeout)
+        if self.backlog_thread is not None:
+            self.backlog_thread.join(max(0.0, deadline - time.monotonic()))
+            drained = drained and not self.backlog_thread.is_alive()
+        if not drained:
+            self.logger.warning(f"{self.shutdown_timeout} 秒内未写完在途记录: {self.budget.stats()}，"
+                                f"重启后从游标 {self.cursor.committed} 继续")
+        self.executor.shutdown(wait=drained, cancel_futures=not drained)
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=drained, cancel_futures=not drained)
+        self.logger.warning("已停止")
 
-                        break  # 成功执行后跳出重试循环
 
-                    except Exception as e:
-                        delay = min(
-                            retry_config['initial_delay'] * (retry_config['backoff_factor'] ** attempt),
-                            retry_config['max_delay']
-                        )
-                        if attempt < retry_config['max_retries'] - 1:
-                            self.logger.warning(f"第 {attempt + 1} 次尝试失败: {e}，{delay} 秒后重试")
-                            time.sleep(delay)
-                        else:
-                            raise
+class Es_v2(Es):
+    """
+    ipbw agent数据处理
+    """
+    schema = IPBANDWIDTH
 
-            except Exception as e:
-                self.logger.error(f"NettrafficAnalyzer_for_ELK运行发生错误: {e}")
 
-            time.sleep(self.check_interval)
\ No newline at end of file
+class Es_v3(Es):
+    """
+    ipbw agent数据处理
+    """
+    schema = IPBW
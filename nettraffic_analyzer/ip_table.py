@@ -0,0 +1,151 @@
+"""
+china.xdb 展开后的 /24 直接索引表
+
+每个 /24 网段对应表中一项区域ID，查询只需一次数组下标加一次区域表读取。
+一个 /24 内存在多个区域(或部分地址无记录)时，该项为 FALLBACK，由调用方回退到 XdbSearcher。
+
+文件格式(小端):
+    头部 64 字节: 魔数 "XDBT" | 格式版本 u16 | 区域ID宽度 u16 (2/4) | 生成时间 u32
+                  | xdb 文件大小 u64 | xdb 头部前16字节 | 区域数 u32 | 区域表偏移 u64 | 填充
+    索引表: 2^24 个区域ID，0 表示无记录
+    区域表: (区域数 + 1) 个 u32 偏移，随后是 utf-8 区域字符串
+
+生成: python -m nettraffic_analyzer.ip_table res/china.xdb res/china.xdb.tbl
+"""
+import argparse
+import io
+import mmap
+import os
+import struct
+import time
+from array import array
+
+from nettraffic_analyzer.xdbSearcher import XdbSearcher
+
+TABLE_MAGIC = b"XDBT"
+TABLE_VERSION = 1
+TABLE_HEADER = struct.Struct("<4sHHIQ16sIQ")
+TABLE_HEADER_SIZE = 64
+BLOCK_COUNT = 1 << 24
+
+
+class IpTable:
+    """
+    内存映射的 /24 直接索引表
+    """
+
+    def __init__(self, table_path):
+        with io.open(table_path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, width, self.created, self.xdb_size, self.xdb_header, \
+            self.region_count, region_offset = TABLE_HEADER.unpack_from(self.mm, 0)
+        if magic != TABLE_MAGIC or version != TABLE_VERSION or width not in (2, 4):
+            self.mm.close()
+            raise ValueError(f"{table_path} 不是有效的索引表 (magic={magic!r}, version={version}, width={width})")
+        self.width = width
+        self.fallback = (1 << (8 * width)) - 1
+        view = memoryview(self.mm)
+        self.ids = view[TABLE_HEADER_SIZE:TABLE_HEADER_SIZE + BLOCK_COUNT * width].cast("H" if width == 2 else "I")
+        offsets_end = region_offset + (self.region_count + 1) * 4
+        self.region_offsets = view[region_offset:offsets_end].cast("I")
+        self.region_base = offsets_end
+
+    def matches(self, searcher):
+        """
+        索引表是否由当前加载的 xdb 生成
+        """
+        content = searcher.contentBuff
+        return self.xdb_size == len(content) and self.xdb_header == bytes(content[:16])
+
+    def lookup(self, ip):
+        """
+        :param ip: 整数形式的 IPv4 地址
+        :return: 区域ID，0 为无记录，self.fallback 表示需要回退到 XdbSearcher
+        """
+        return self.ids[ip >> 8]
+
+    def region_string(self, region_id):
+        if region_id == 0:
+            return ""
+        start = self.region_base + self.region_offsets[region_id - 1]
+        end = self.region_base + self.region_offsets[region_id]
+        return str(self.mm[start:end], "utf-8")
+
+    def close(self):
+        self.ids.release()
+        self.region_offsets.release()
+        self.mm.close()
+
+
+def build_table(db_path, table_path):
+    """
+    从 china.xdb 生成 /24 直接索引表
+
+    :return: (区域数, 回退网段数)
+    """
+    searcher = XdbSearcher(contentBuff=XdbSearcher.loadContentFromFile(dbfile=db_path))
+    searcher.loadSegmentIndex()
+    region_ids = {}
+    regions = []
+    # 未被单个段完整覆盖的网段: block -> [区域ID集合, 已覆盖地址数]
+    partial = {}
+    spans = []
+    for sip, eip, data_len, data_ptr in zip(searcher.segSip, searcher.segEip, searcher.segDataLen, searcher.segDataPtr):
+        region = searcher.readString(data_ptr, data_len)
+        region_id = region_ids.get(region)
+        if region_id is None:
+            regions.append(region)
+            region_id = region_ids[region] = len(regions)
+        first_full = (sip + 255) >> 8
+        last_full = ((eip + 1) >> 8) - 1
+        if first_full <= last_full:
+            spans.append((first_full, last_full + 1, region_id))
+        for block in {sip >> 8, eip >> 8}:
+            if first_full <= block <= last_full:
+                continue
+            covered = min(eip, (block << 8) | 0xFF) - max(sip, block << 8) + 1
+            entry = partial.setdefault(block, [set(), 0])
+            entry[0].add(region_id)
+            entry[1] += covered
+
+    width = 2 if len(regions) < 0xFFFF else 4
+    fallback = (1 << (8 * width)) - 1
+    ids = array("H" if width == 2 else "I", bytes(BLOCK_COUNT * width))
+    for start, stop, region_id in spans:
+        ids[start:stop] = array(ids.typecode, [region_id]) * (stop - start)
+    for block, (block_regions, covered) in partial.items():
+        ids[block] = block_regions.pop() if covered == 256 and len(block_regions) == 1 else fallback
+
+    blobs = [region.encode("utf-8") for region in regions]
+    offsets = array("I", [0])
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+
+    content = searcher.contentBuff
+    region_offset = TABLE_HEADER_SIZE + BLOCK_COUNT * width
+    header = TABLE_HEADER.pack(TABLE_MAGIC, TABLE_VERSION, width, int(time.time()),
+                               len(content), bytes(content[:16]), len(regions), region_offset)
+    tmp_path = f"{table_path}.{os.getpid()}.tmp"
+    with io.open(tmp_path, "wb") as f:
+        f.write(header.ljust(TABLE_HEADER_SIZE, b"\0"))
+        ids.tofile(f)
+        offsets.tofile(f)
+        f.write(b"".join(blobs))
+    os.replace(tmp_path, table_path)
+    searcher.close()
+    return len(regions), ids.count(fallback)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="从 china.xdb 生成 /24 直接索引表")
+    arg_parser.add_argument("db_path", nargs="?", default="res/china.xdb")
+    arg_parser.add_argument("table_path", nargs="?", default="res/china.xdb.tbl")
+    args = arg_parser.parse_args()
+    start = time.time()
+    region_count, fallback_count = build_table(args.db_path, args.table_path)
+    print(f"已生成 {args.table_path}: {region_count} 个区域, {fallback_count} 个 /24 需回退查询, "
+          f"耗时 {round(time.time() - start, 2)}s")
+
+
+if __name__ == "__main__":
+    main()
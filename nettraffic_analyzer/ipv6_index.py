@@ -0,0 +1,209 @@
+"""
+本地 IPv6 归属地区间索引，从 MySQL ipv6_china_mainland 表导出
+
+文件格式(小端):
+    头部 32 字节: 魔数 "XV6I" | 格式版本 u16 | 保留 u16 | 生成时间 u32 | 区间数 u64 | 区域数 u32 | 填充
+    区间列(各 区间数 项，按起始地址升序):
+        起始地址高64位 u64 | 起始地址低64位 u64 | 结束地址高64位 u64 | 结束地址低64位 u64
+        | 结束地址前缀最大值高64位 u64 | 前缀最大值低64位 u64 | 区域ID u32
+    区域表: (区域数 + 1) 个 u32 偏移，随后是 utf-8 的 "省份|城市|运营商"
+
+导出: python -m nettraffic_analyzer.ipv6_index res/ipv6_china_mainland.idx
+"""
+import argparse
+import io
+import json
+import mmap
+import os
+import socket
+import struct
+import time
+from array import array
+from bisect import bisect_right
+
+import mysql.connector
+
+INDEX_MAGIC = b"XV6I"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<4sHHIQI")
+INDEX_HEADER_SIZE = 32
+U64_MASK = (1 << 64) - 1
+
+# resolve_ip_region(ipv6=True) 用到的 ipv6_china_mainland 列序号
+ISP_COLUMN = 6
+PROVINCE_COLUMN = 13
+CITY_COLUMN = 15
+
+
+class _Bound128:
+    """
+    把高/低两列 u64 拼成 128 位整数序列，供 bisect 使用
+    """
+
+    def __init__(self, hi, lo):
+        self.hi = hi
+        self.lo = lo
+
+    def __len__(self):
+        return len(self.hi)
+
+    def __getitem__(self, i):
+        return (self.hi[i] << 64) | self.lo[i]
+
+
+class Ipv6Index:
+    """
+    内存映射的 IPv6 区间索引，进程内二分查找
+    """
+
+    def __init__(self, index_path):
+        with io.open(index_path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.created, count, self.region_count = INDEX_HEADER.unpack_from(self.mm, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            self.mm.close()
+            raise ValueError(f"{index_path} 不是有效的 IPv6 索引 (magic={magic!r}, version={version})")
+        view = memoryview(self.mm)
+        offset = INDEX_HEADER_SIZE
+        columns = []
+        for _ in range(6):
+            columns.append(view[offset:offset + count * 8].cast("Q"))
+            offset += count * 8
+        self.region_ids = view[offset:offset + count * 4].cast("I")
+        offset += count * 4
+        self.region_offsets = view[offset:offset + (self.region_count + 1) * 4].cast("I")
+        self.region_base = offset + (self.region_count + 1) * 4
+        self.views = columns + [self.region_ids, self.region_offsets]
+        self.min_ip = _Bound128(columns[0], columns[1])
+        self.max_ip = _Bound128(columns[2], columns[3])
+        self.prefix_max_ip = _Bound128(columns[4], columns[5])
+        self.region_fields = {}
+
+    def __len__(self):
+        return len(self.region_ids)
+
+    def search(self, ipv6_address):
+        """
+        与 MySQL 查询语义一致：包含该地址的区间中起始地址最大的一个
+
+        :return: (省份, 城市, 运营商)，查不到返回 None
+        """
+        try:
+            ip = int.from_bytes(socket.inet_pton(socket.AF_INET6, ipv6_address), "big")
+        except (OSError, TypeError, ValueError):
+            return None
+        i = bisect_right(self.min_ip, ip) - 1
+        # 区间不重叠时最多检查一次；前缀最大值小于 ip 说明更早的区间都不可能包含它
+        while i >= 0 and self.prefix_max_ip[i] >= ip:
+            if self.max_ip[i] >= ip:
+                return self.region(self.region_ids[i])
+            i -= 1
+        return None
+
+    def region(self, region_id):
+        fields = self.region_fields.get(region_id)
+        if fields is None:
+            start = self.region_base + self.region_offsets[region_id]
+            end = self.region_base + self.region_offsets[region_id + 1]
+            fields = self.region_fields[region_id] = tuple(str(self.mm[start:end], "utf-8").split("|"))
+        return fields
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        self.mm.close()
+
+
+def export_index(index_path, db_host, db_user, db_password, db_database):
+    """
+    把 ipv6_china_mainland 导出为本地区间索引文件
+
+    :return: (区间数, 区域数)
+    """
+    connection = mysql.connector.connect(host=db_host, user=db_user, password=db_password, database=db_database)
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT * FROM ipv6_china_mainland ORDER BY ip_dig_min_bin")
+        min_column = cursor.column_names.index("ip_dig_min_bin")
+        max_column = cursor.column_names.index("ip_dig_max_bin")
+        rows = [
+            (row[min_column], row[max_column], row[PROVINCE_COLUMN], row[CITY_COLUMN], row[ISP_COLUMN])
+            for row in cursor
+        ]
+        cursor.close()
+    finally:
+        connection.close()
+    return write_index(index_path, rows)
+
+
+def write_index(index_path, rows):
+    """
+    :param rows: (起始地址, 结束地址, 省份, 城市, 运营商)，地址为 INET6_ATON 的 16 字节
+    :return: (区间数, 区域数)
+    """
+    ranges = []
+    region_ids = {}
+    regions = []
+    for ip_min, ip_max, province, city, isp in rows:
+        ip_min, ip_max = bytes(ip_min or b""), bytes(ip_max or b"")
+        if len(ip_min) != 16 or len(ip_max) != 16:
+            continue
+        region = "|".join(str(value or "") for value in (province, city, isp))
+        region_id = region_ids.get(region)
+        if region_id is None:
+            region_id = region_ids[region] = len(regions)
+            regions.append(region)
+        ranges.append((int.from_bytes(ip_min, "big"), int.from_bytes(ip_max, "big"), region_id))
+
+    ranges.sort(key=lambda item: item[0])
+    columns = [array("Q") for _ in range(6)]
+    ids = array("I")
+    prefix_max = -1
+    for ip_min, ip_max, region_id in ranges:
+        prefix_max = max(prefix_max, ip_max)
+        for column, value in zip(columns, (ip_min >> 64, ip_min & U64_MASK, ip_max >> 64, ip_max & U64_MASK,
+                                           prefix_max >> 64, prefix_max & U64_MASK)):
+            column.append(value)
+        ids.append(region_id)
+
+    blobs = [region.encode("utf-8") for region in regions]
+    offsets = array("I", [0])
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with io.open(tmp_path, "wb") as f:
+        header = INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, 0, int(time.time()), len(ranges), len(regions))
+        f.write(header.ljust(INDEX_HEADER_SIZE, b"\0"))
+        for column in columns:
+            column.tofile(f)
+        ids.tofile(f)
+        offsets.tofile(f)
+        f.write(b"".join(blobs))
+    os.replace(tmp_path, index_path)
+    return len(ranges), len(regions)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="导出 ipv6_china_mainland 为本地 IPv6 区间索引")
+    arg_parser.add_argument("index_path", nargs="?", default="res/ipv6_china_mainland.idx")
+    arg_parser.add_argument("--config", default="config/config.json", help="读取 db_host 等数据库配置")
+    args = arg_parser.parse_args()
+    try:
+        with open(args.config, "r") as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        config = {}
+    start = time.time()
+    range_count, region_count = export_index(
+        args.index_path,
+        config.get('db_host', 'localhost'),
+        config.get('db_user', 'root'),
+        config.get('db_password', 'mspvAtxchJA2'),
+        config.get('db_database', 'ipv6'),
+    )
+    print(f"已导出 {args.index_path}: {range_count} 个区间, {region_count} 个区域, 耗时 {round(time.time() - start, 2)}s")
+
+
+if __name__ == "__main__":
+    main()
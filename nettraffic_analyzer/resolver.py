@@ -3,14 +3,31 @@
 # Website: https://www.yzgsa.com
 # Copyright (c) <yuanzigsa@gmail.com>
 import json
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+from array import array
 from enum import Enum
+from types import MappingProxyType
 import logging
 import re
-from nettraffic_analyzer.xdbSearcher import XdbSearcher
-from nettraffic_analyzer.utils import setup_logger, ipv6_search
+import mysql.connector
+from nettraffic_analyzer.xdbSearcher import XdbSearcher, HeaderInfoLength, SegmentIndexSize
+from nettraffic_analyzer.ip_table import IpTable
+from nettraffic_analyzer.ipv6_index import Ipv6Index
+from nettraffic_analyzer.cache import IntervalCache, TtlCache
+from nettraffic_analyzer.config_cache import JsonFileCache
+from nettraffic_analyzer.utils import get_elk_config, Ipv6Searcher
 
 logger = logging.getLogger(__name__)
 
+IPV4_PATTERN = re.compile(
+    r'^(25[0-5]|2[0-4][0-9]|1[0-9]{2}|[1-9]?[0-9])(\.(25[0-5]|2[0-4][0-9]|1[0-9]{2}|[1-9]?[0-9])){3}$')
+
 
 class Isp(Enum):
     CHINA_MOBILE = "中国移动"
@@ -18,19 +35,284 @@ class Isp(Enum):
     CHINA_TELECOM = "中国电信"
 
 
-class Resolver:
+class Region(dict):
+    """
+    不可变的归属地信息，内容相同的实例全局只保留一份
+    仍是 dict 子类，可以直接作为ES文档字段序列化
+    isp_code / province_code 是去掉"中国"后的运营商名称和省份的进程内整数编码，0 为"未知"
+    """
+    __slots__ = ('isp_code', 'province_code')
+    _pool = {}
+    _codes_lock = threading.Lock()
+    isp_names = ['未知']
+    isp_codes = {'未知': 0}
+    province_names = ['未知']
+    province_codes = {'未知': 0}
+
+    @classmethod
+    def intern(cls, fields):
+        key = tuple(fields.items())
+        region = cls._pool.get(key)
+        if region is None:
+            region = cls(fields)
+            region.isp_code = cls.code(cls.isp_codes, cls.isp_names, fields['isp'].replace('中国', ''))
+            region.province_code = cls.code(cls.province_codes, cls.province_names, fields.get('province'))
+            region = cls._pool.setdefault(key, region)
+        return region
+
+    @classmethod
+    def code(cls, codes, names, name):
+        code = codes.get(name)
+        if code is None:
+            with cls._codes_lock:
+                code = codes.get(name)
+                if code is None:
+                    # 先追加名称再登记编码，读取方拿到编码时名称一定已存在
+                    names.append(name)
+                    code = codes[name] = len(names) - 1
+        return code
+
+    @property
+    def isp_name(self):
+        return self.isp_names[self.isp_code]
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Region 不可修改，请用 Region.intern 生成新对象")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __hash__(self):
+        return hash(tuple(self.items()))
+
+    def __reduce__(self):
+        return Region.intern, (dict(self),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class FlowIspTypeTable:
+    """
+    flow_isp_type 分类表: rows[agent 运营商编码][dst 运营商编码] = (跨省结果, 省内结果)
+    出现新的运营商编码时整表重建，结果字符串全部预先生成
+    """
+
     def __init__(self):
-        dbPath = "res/china.xdb"
-        self.cb = XdbSearcher.loadContentFromFile(dbfile=dbPath)
+        self.rows = []
+        self.lock = threading.Lock()
+
+    def build(self):
+        with self.lock:
+            names = list(Region.isp_names)
+            if len(self.rows) >= len(names):
+                return self.rows
+            other = [sys.intern('异网(未知)' if not name else f'异网({name})') for name in names]
+            same = (sys.intern('同网跨省'), sys.intern('同网省内'))
+            self.rows = [
+                [same if agent == dst and agent != 0 else (other[dst], other[dst]) for dst in range(len(names))]
+                for agent in range(len(names))
+            ]
+            return self.rows
+
+    def classify(self, agent_ip_info, dst_ip_info):
+        return self.classify_many([agent_ip_info], [dst_ip_info])[0]
+
+    def classify_many(self, agent_ip_infos, dst_ip_infos):
+        """
+        :param agent_ip_infos: agent_ip 的 Region 列表
+        :param dst_ip_infos: 与之一一对应的目标 IP 的 Region 列表
+        :return: flow_isp_type 列表
+        """
+        rows = self.rows
+        if len(rows) < len(Region.isp_names):
+            rows = self.build()
+        try:
+            return [
+                rows[agent.isp_code][dst.isp_code][agent.province_code == dst.province_code]
+                for agent, dst in zip(agent_ip_infos, dst_ip_infos)
+            ]
+        except IndexError:
+            # 检查之后其它线程又登记了新的运营商
+            rows = self.build()
+            return [
+                rows[agent.isp_code][dst.isp_code][agent.province_code == dst.province_code]
+                for agent, dst in zip(agent_ip_infos, dst_ip_infos)
+            ]
+
+
+class EnrichmentTemplate:
+    """
+    一个已配置接口 (host_ip, ifindex) 的预计算字段，只取决于接口配置、cacti 数据和 xdb 版本
+    """
+    __slots__ = ('agent_ip', 'agent_ip_info', 'fields')
+
+    def __init__(self, agent_ip, agent_ip_info, fields):
+        self.agent_ip = agent_ip
+        self.agent_ip_info = agent_ip_info
+        # 节点、客户、端口、流量方向和 cacti 流量最大值，直接合并进 _source
+        self.fields = MappingProxyType(fields)
+
+
+class IpDatabase:
+    """
+    某一版本的 china.xdb：常驻的查询对象和与之绑定的区域缓存
+    热更新时整体替换，进行中的批次继续使用自己拿到的旧版本
+    """
+    # 加载后用来校验的探测地址
+    probe_ips = ("1.1.1.1", "114.114.114.114", "223.5.5.5")
+
+    def __init__(self, db_path, use_mmap=False, segment_index=False, table_path=None):
+        self.path = db_path
+        self.signature = self.file_signature(db_path)
+        self.mmap = use_mmap
+        if use_mmap:
+            # 多个进程映射同一文件，共享一份页缓存，启动时不整读
+            content = XdbSearcher.loadContentMmapFromFile(dbfile=db_path)
+        else:
+            content = XdbSearcher.loadContentFromFile(dbfile=db_path)
+        if content is None:
+            raise IOError(f"无法读取 {db_path}")
+        # 批量查询用的段索引列只构建一次
+        self.searcher = XdbSearcher(contentBuff=content)
+        if segment_index:
+            # 启动时预解码段索引，缓存到 china.xdb.seg，之后启动直接读取
+            self.searcher.loadSegmentIndex(cacheFile=f"{db_path}.seg")
+        # dataPtr -> Region，库里只有几千种不同的区域记录
+        self.region_cache = {}
+        # 可选的 /24 直接索引表，见 ip_table.py
+        self.table = None
+        self.table_region_cache = {}
+        if table_path:
+            self.table = self.load_table(table_path)
+
+    def load_table(self, table_path):
+        try:
+            table = IpTable(table_path)
+        except (OSError, ValueError) as e:
+            logger.error(f"加载索引表 {table_path} 失败，使用 xdb 查询: {e}")
+            return None
+        if not table.matches(self.searcher):
+            logger.warning(f"索引表 {table_path} 与当前 {self.path} 不匹配，请重新生成")
+            table.close()
+            return None
+        return table
+
+    @staticmethod
+    def file_signature(db_path):
+        stat = os.stat(db_path)
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def validate(self):
+        """
+        检查头部和段索引边界，并试查几个地址，不合法时抛出 ValueError
+        """
+        content = self.searcher.contentBuff
+        if len(content) < HeaderInfoLength:
+            raise ValueError("xdb 文件过短")
+        start_ptr, end_ptr = struct.unpack_from("<II", content, 8)
+        if not (HeaderInfoLength <= start_ptr <= end_ptr
+                and end_ptr + SegmentIndexSize <= len(content)
+                and (end_ptr - start_ptr) % SegmentIndexSize == 0):
+            raise ValueError(f"xdb 段索引范围异常: {start_ptr}-{end_ptr}, 文件大小 {len(content)}")
+        for ip in self.probe_ips:
+            data_ptr, data_len = self.searcher.searchPtr(ip)
+            if data_ptr >= 0:
+                content_str = self.searcher.readString(data_ptr, data_len)
+                if content_str and '|' not in content_str:
+                    raise ValueError(f"xdb 区域记录异常: {ip} -> {content_str!r}")
+
+
+flow_isp_types = FlowIspTypeTable()
+
+
+class Resolver:
+    # /24 网段 -> 运营商，覆盖 xdb 中的记录
+    isp_overrides = {
+        (120 << 16) | (72 << 8) | 50: Isp.CHINA_UNICOM.value,
+    }
+
+    def __init__(self, background=True):
+        """
+        :param background: 是否启动 xdb 热更新、elk 配置轮询和IPv6延迟解析的后台线程；
+                           进程池子进程传 False，只保留 xdb 查询、缓存和接口模板，xdb 在处理数据时顺带检查更新
+        """
+        self.db_path = "res/china.xdb"
         try:
             with open("config/config.json", "r") as f:
                 config = json.load(f)
         except FileNotFoundError:
             config = {}      
+        # 映射文件时热更新必须先写临时文件再 mv 替换，不能 cp 就地覆盖，否则已映射的旧内容会被改写
+        # 开启进程池时默认映射文件，各子进程共享同一份页缓存
+        self.xdb_mmap = bool(config.get('xdb_mmap', bool(config.get('enrich_processes'))))
+        self.xdb_segment_index = bool(config.get('xdb_segment_index'))
+        # /24 直接索引表路径，用 python -m nettraffic_analyzer.ip_table 生成
+        self.xdb_table = config.get('xdb_table')
+        self.db = IpDatabase(self.db_path, self.xdb_mmap, self.xdb_segment_index, self.xdb_table)
+        # 进程内所有批次、线程共享的 整数IPv4 -> Region 缓存，存 rewrite_ipinfo 之前的结果，重新加载 xdb 时清空
+        self.ip_cache = TtlCache(max_size=config.get('ip_cache_size', 500000), ttl=config.get('ip_cache_ttl', 3600))
+        # xdb 段 [起始IP, 结束IP] -> Region，同一段内的其它地址不再查 xdb，同样在重新加载时清空
+        self.ip_range_cache = IntervalCache(max_size=config.get('ip_range_cache_size', 100000))
+        self.xdb_reload_lock = threading.Lock()
+        # 检查 china.xdb 是否更新的间隔(秒)，0 表示不热更新
+        self.xdb_reload_interval = config.get('xdb_reload_interval', 30)
+        self.xdb_checked = time.monotonic()
+        self.xdb_failed_signature = None
+        if self.xdb_reload_interval and background:
+            threading.Thread(target=self.watch_xdb, name="xdb-watcher", daemon=True).start()
         self.db_host = config.get('db_host', 'localhost')
         self.db_user = config.get('db_user', 'root')
         self.db_password = config.get('db_password', 'mspvAtxchJA2')
         self.db_database = config.get('db_database', 'ipv6')
+        # config_data.json 和 sflow_cacti_data.json 只在内容变化时重新解析
+        self.config_data_cache = JsonFileCache('res/config_data.json', {
+            'agent_ip_index_map': self.build_agent_ip_index_map,
+            'host_ip_index_map': self.build_host_ip_index_map,
+        })
+        self.sflow_cacti_cache = JsonFileCache('res/sflow_cacti_data.json', {
+            'sflow_cacti_data': self.build_sflow_cacti_data,
+        })
+        # 配置了接口地址时，另外通过 HTTP 轮询(ETag)更新 config_data
+        self.elk_config_url = config.get('elk_config_url')
+        # ((接口配置, cacti 数据, IpDatabase), {"host_ip_ifindex": EnrichmentTemplate})，任一变化时重建
+        self.templates = ((None, None, None), {})
+        self.templates_lock = threading.Lock()
+        if self.elk_config_url and background:
+            threading.Thread(target=get_elk_config, args=(self.config_data_cache, self.elk_config_url),
+                             name="elk-config", daemon=True).start()
+        self.ipv6_searcher = Ipv6Searcher(self.db_host, self.db_user, self.db_password, self.db_database,
+                                          pool_size=config.get('db_pool_size', 5) if background else 1)
+        # 本地 IPv6 区间索引，用 python -m nettraffic_analyzer.ipv6_index 从 MySQL 导出
+        self.ipv6_index = None
+        if config.get('ipv6_index'):
+            try:
+                self.ipv6_index = Ipv6Index(config['ipv6_index'])
+            except (OSError, ValueError) as e:
+                logger.error(f"加载 IPv6 索引 {config['ipv6_index']} 失败: {e}")
+        # 有本地索引时 MySQL 只作为可选的回退
+        self.ipv6_mysql_fallback = config.get('ipv6_mysql_fallback', self.ipv6_index is None)
+        # MySQL 查询结果跨批次缓存，查不到的地址也缓存，但有效期更短
+        self.ipv6_cache_ttl = config.get('ipv6_cache_ttl', 3600)
+        self.ipv6_negative_ttl = config.get('ipv6_negative_ttl', 300)
+        self.ipv6_cache = TtlCache(max_size=config.get('ipv6_cache_size', 100000))
+        # 延迟解析：未命中的IPv6先写"未知"，后台查询后再对相关文档补发部分更新
+        self.ipv6_deferred = bool(config.get('ipv6_deferred')) and self.ipv6_mysql_fallback
+        self.ipv6_waiting = {}
+        self.ipv6_deferred_lock = threading.Lock()
+        self.ipv6_queue = queue.Queue()
+        # MySQL 查询失败的地址退避后重新排队，每个地址最多重试 ipv6_deferred_retries 次
+        self.ipv6_deferred_retries = config.get('ipv6_deferred_retries', 5)
+        self.ipv6_deferred_backoff = config.get('ipv6_deferred_backoff', 1)
+        self.ipv6_deferred_max_backoff = config.get('ipv6_deferred_max_backoff', 60)
+        self.ipv6_attempts = {}
+        # 由 Es 设置，参数为 [(索引, 文档ID, 更新字段)]
+        self.deferred_update_handler = None
+        if self.ipv6_deferred and background:
+            threading.Thread(target=self.resolve_deferred_ipv6, name="ipv6-deferred", daemon=True).start()
 
     @staticmethod
     def resolve_ip_region(original_content, ipv6=False):
@@ -39,7 +321,7 @@ class Resolver:
 
         :param original_content: 原始查询内容，IPv4 为字符串，IPv6 为列表
         :param ipv6: 是否为 IPv6 查询
-        :return: 包含省份、城市、区县、运营商信息的字典
+        :return: 包含省份、城市、区县、运营商信息的 Region
         """
         # 默认返回值
         default_result = {
@@ -52,31 +334,61 @@ class Resolver:
         # 处理 IPv6 查询结果
         if ipv6:
             if isinstance(original_content, (list, tuple)) and len(original_content) > 15:
-                return {
+                return Region.intern({
                     'province': original_content[13] if original_content[13] else "未知",
                     'city': original_content[15] if original_content[15] else "未知",
                     # 'district': '未知',  # IPv6 结果中可能没有区县信息
                     'isp': original_content[6] if original_content[6] else "未知",
-                }
-            return default_result
+                })
+            return Region.intern(default_result)
 
         # 处理 IPv4 查询结果
         if isinstance(original_content, str) and original_content.strip():
             parts = original_content.split('|')
             if len(parts) > 9:
-                return {
+                return Region.intern({
                     'province': parts[7] if parts[7] else "未知",
                     'city': parts[9] if parts[9] else "未知",
                     'district': parts[4] if parts[4] else "未知",
                     'isp': parts[0] if parts[0] else "未知",
-                }
-        return default_result
+                })
+        return Region.intern(default_result)
+
+    @staticmethod
+    def ipv6_region(fields):
+        """
+        本地 IPv6 索引的 (省份, 城市, 运营商) 转为 Region，与 resolve_ip_region(ipv6=True) 结果一致
+        """
+        province, city, isp = fields
+        return Region.intern({
+            'province': province if province else "未知",
+            'city': city if city else "未知",
+            'isp': isp if isp else "未知",
+        })
+
+    @staticmethod
+    def flow_isp_type(agent_ip_info, dst_ip_info):
+        return flow_isp_types.classify(agent_ip_info, dst_ip_info)
 
     @staticmethod
-    def is_ipv4(ip):
-        ipv4_pattern = re.compile(
-            r'^(25[0-5]|2[0-4][0-9]|1[0-9]{2}|[1-9]?[0-9])(\.(25[0-5]|2[0-4][0-9]|1[0-9]{2}|[1-9]?[0-9])){3}$')
-        return bool(ipv4_pattern.match(ip))
+    def parse_ipv4(ip, ip_longs=None):
+        """
+        把地址字符串解析为整数，同一字符串在 ip_longs 中只解析一次
+
+        :param ip_longs: 调用方的 {地址: 整数或 None} 缓存
+        :return: IPv4 地址的整数形式，不是 IPv4 时为 None
+        """
+        if ip_longs is not None and ip in ip_longs:
+            return ip_longs[ip]
+        ip_long = None
+        if IPV4_PATTERN.match(ip):
+            try:
+                ip_long = int.from_bytes(socket.inet_aton(ip), "big")
+            except OSError:
+                pass
+        if ip_longs is not None:
+            ip_longs[ip] = ip_long
+        return ip_long
 
     @staticmethod
     def get_flow_detail(ip, interface, agent_ip_index_map):
@@ -107,289 +419,367 @@ class Resolver:
             return "未知", "未知", "未知", "未知"
 
     @staticmethod
-    def read_sflow_cacti_data():
-        try:
-            with open('res/sflow_cacti_data.json', 'r') as f:
-                data = json.load(f)
-            sflow_cacti_data = {int(item['local_graph_id']): item for item in data}
-            return sflow_cacti_data
+    def build_sflow_cacti_data(data):
+        return {int(item['local_graph_id']): item for item in data}
 
-        except Exception as e:
-            logger.error(f"Error in sflow_cacti_data: {e}")
-            return {}
-        
     @staticmethod
-    def read_config_data():
-        try:
-            with open('res/config_data.json', 'r') as f:
-                data = json.load(f)
-                # logger.info(f"当前配置：{data}")
-            # 构建查找字典
-            # host_ip_index_map = {f"{item['host_ip']}_{item['interface']}": item for item in data}
-            agent_ip_index_map = {f"{item['host_ip']}_{item['interface']}": item for item in data}
-            return agent_ip_index_map
+    def build_agent_ip_index_map(data):
+        return {f"{item['host_ip']}_{item['interface']}": item for item in data}
 
-        except Exception as e:
-            logger.error(f"Error in read_config_data: {e}")
-            return {}
-        
     @staticmethod
-    def read_config_data_v2():
-        try:
-            with open('res/config_data.json', 'r') as f:
-                data = json.load(f)
-            host_ip_index_map = {f"{item['host_ip']}": item for item in data}
-            return host_ip_index_map
+    def build_host_ip_index_map(data):
+        return {f"{item['host_ip']}": item for item in data}
+
+    def read_sflow_cacti_data(self):
+        return self.sflow_cacti_cache.get('sflow_cacti_data')
+
+    def read_config_data(self):
+        return self.config_data_cache.get('agent_ip_index_map')
+
+    def read_config_data_v2(self):
+        return self.config_data_cache.get('host_ip_index_map')
 
-        except Exception as e:
-            logger.error(f"Error in read_config_data: {e}")
-            return {}
-        
     @staticmethod
     def _get_agent_ip(data, host_ip, interface):
          for item in data:
              if item['host_ip'] == host_ip and item['interface'] == interface:
                  return item['agent_ip']
 
-    @staticmethod
-    def rewrite_ipinfo(ip, ipinfo, isv4=True):
-        if isv4:
-            ipinfo['isp'] = "中国联通" if ip and ip.startswith('120.72.50') else ipinfo['isp']
-
+    @classmethod
+    def rewrite_ipinfo(cls, ip, ipinfo, isv4=True):
+        """
+        :param ip: 字符串或整数形式的 IPv4 地址
+        """
+        if not isv4 or not ip:
+            return ipinfo
+        if isinstance(ip, str):
+            ip = cls.parse_ipv4(ip)
+            if ip is None:
+                return ipinfo
+        isp = cls.isp_overrides.get(ip >> 8)
+        if isp is not None:
+            ipinfo = Region.intern({**ipinfo, 'isp': isp})
         return ipinfo
 
-    def rewrite_docs(self, docs):
-        """
-        重写elasticsearch查询结果，添加IP归属地信息
-            1. 同运营商省内比例-同网省内
-            2. 同运营商出省比例-同网跨省
-            3. 去往移动的比例-异网(移动)
-            4. 去往联通的比例-异网(联通)
-            5. 去往电信的比例-异网(电信)
-        """
-        # 默认情况下agent_ip和host_ip是一样的，但在三线情况下可能不同，所以以agent_ip为准
-        searcher = XdbSearcher(contentBuff=self.cb)
-        agent_ip_index_config_map = self.read_config_data()
-        sflow_cacti_data_map = self.read_sflow_cacti_data()
-        new_docs = []
-        # IP信息缓存
-        ip_info_cache = {}
+    def watch_xdb(self):
+        """
+        后台轮询 china.xdb，文件变化后重新加载
+        开启 xdb_mmap 时更新应先写临时文件再 mv 替换(换一个 inode)；
+        inode 不变说明文件被就地覆盖，映射中的旧内容已不可靠，这次改为整读到内存
+        """
+        while True:
+            time.sleep(self.xdb_reload_interval)
+            self.check_xdb()
+
+    def poll_xdb(self):
+        """
+        没有后台线程时由调用方在处理数据前调用，距上次检查超过 xdb_reload_interval 才检查文件
+        """
+        now = time.monotonic()
+        if self.xdb_reload_interval and now - self.xdb_checked >= self.xdb_reload_interval:
+            self.xdb_checked = now
+            self.check_xdb()
+
+    def check_xdb(self):
         try:
-            for doc in docs:
-                source = doc['_source']
-                host_ip = source['host'].get('ip')
-                src_ip = source.get('src_ip')
-                dst_ip = source.get('dst_ip')
-                ifindex = source.get('source_id_index')
-                config = agent_ip_index_config_map.get(f"{host_ip}_{ifindex}",{})
-                agent_ip = config.get('agent_ip')
-                if not all([src_ip, dst_ip, host_ip, agent_ip]):
+            signature = IpDatabase.file_signature(self.db_path)
+        except OSError as e:
+            logger.error(f"检查 {self.db_path} 出错: {e}")
+            return
+        if signature == self.db.signature or signature == self.xdb_failed_signature:
+            return
+        use_mmap = self.xdb_mmap
+        if self.db.mmap and signature[0] == self.db.signature[0]:
+            logger.error(f"{self.db_path} 被就地覆盖，开启 xdb_mmap 时请先写临时文件再 mv 替换，本次整读到内存")
+            use_mmap = False
+        if not self.reload_xdb(use_mmap):
+            self.xdb_failed_signature = signature
+
+    def reload_xdb(self, use_mmap=None):
+        """
+        在后台构建并校验新版本的 china.xdb，成功后原子替换 self.db
+        旧版本在进行中的批次结束后随引用释放，旧版本的缓存一并失效
+
+        :param use_mmap: 是否映射文件，默认按 xdb_mmap 配置
+        :return: 是否替换成功
+        """
+        if use_mmap is None:
+            use_mmap = self.xdb_mmap
+        with self.xdb_reload_lock:
+            start = time.time()
+            try:
+                db = IpDatabase(self.db_path, use_mmap, self.xdb_segment_index, self.xdb_table)
+                db.validate()
+            except Exception as e:
+                logger.error(f"重新加载 {self.db_path} 失败，继续使用旧版本: {e}")
+                return False
+            self.db = db
+            self.ip_cache.clear()
+            self.ip_range_cache.clear()
+            logger.warning(f"已重新加载 {self.db_path}，耗时：{round(time.time() - start, 2)}s")
+            return True
+
+    def region_by_ptr(self, db, data_ptr, data_len):
+        """
+        按 xdb 数据指针取解析好的 Region，同一区域只解码、解析一次
+        """
+        region = db.region_cache.get(data_ptr)
+        if region is None:
+            content = db.searcher.readString(data_ptr, data_len) if data_ptr >= 0 else ""
+            region = db.region_cache[data_ptr] = self.resolve_ip_region(content)
+        return region
+
+    def region_by_table_id(self, db, region_id):
+        region = db.table_region_cache.get(region_id)
+        if region is None:
+            region = db.table_region_cache[region_id] = self.resolve_ip_region(db.table.region_string(region_id))
+        return region
+
+    def prefetch_ipv4_info(self, db, pending, ip_info_cache, ip_longs=None):
+        """
+        对一页文档中的IPv4地址做一次批量查询，结果写入 ip_info_cache
+        依次查共享的 self.ip_cache、/24 索引表、xdb 段区间缓存，最后才查 xdb
+        每个地址只解析一次为整数，之后都按整数查询
+
+        :param db: 本批次使用的 IpDatabase
+        :param pending: {ip: 是否调用 rewrite_ipinfo}，按首次出现的顺序
+        :param ip_info_cache: 本批次的IP信息缓存
+        :param ip_longs: 本批次 {地址: 整数或 None} 的缓存，见 parse_ipv4
+        """
+        if ip_longs is None:
+            ip_longs = {}
+        ips = []
+        for ip in pending:
+            if ip in ip_info_cache:
+                continue
+            ip_long = self.parse_ipv4(ip, ip_longs)
+            if ip_long is None:
+                continue
+            ip_info = self.ip_cache.get(ip_long)
+            if ip_info is None:
+                ips.append((ip, ip_long))
+            else:
+                ip_info_cache[ip] = self.rewrite_ipinfo(ip_long, ip_info) if pending[ip] else ip_info
+        if db.table is not None:
+            # 直接索引表命中的地址不再查 xdb，只有跨区域的 /24 回退
+            fallback_ips = []
+            for ip, ip_long in ips:
+                region_id = db.table.lookup(ip_long)
+                if region_id == db.table.fallback:
+                    fallback_ips.append((ip, ip_long))
                     continue
-                if agent_ip not in ip_info_cache:
-                    result = searcher.search(agent_ip)
-                    ip_info_cache[agent_ip] = self.rewrite_ipinfo(agent_ip, self.resolve_ip_region(result))
-                agent_ip_info = ip_info_cache[agent_ip]
-    
-                # 使用缓存获取IP信息
-                is_ipv4 = self.is_ipv4(dst_ip)
-                source['ipType'] = "ipv4" if is_ipv4 else "ipv6"
-                
-                # 获取源IP和目标IP信息
-                for ip in (src_ip, dst_ip):
-                    if ip not in ip_info_cache:
-                        if is_ipv4:
-                            result = searcher.search(ip)
-                            ip_info_cache[ip] = self.rewrite_ipinfo(ip, self.resolve_ip_region(result))
-                        else:
-                            result = ipv6_search(ip, self.db_host, self.db_user, self.db_password, self.db_database)
-                            ip_info_cache[ip] = self.resolve_ip_region(result, ipv6=True)
-                
-                src_ip_info = ip_info_cache[src_ip]
-                dst_ip_info = ip_info_cache[dst_ip]
-                
-                # 处理ISP信息
-                agent_isp = agent_ip_info.get('isp').replace('中国', '')
-                dst_isp = dst_ip_info.get('isp').replace('中国', '')
-                
-                # 设置流量类型
-                if agent_isp != "未知" and dst_isp != "未知" and agent_isp == dst_isp:
-                    source['flow_isp_type'] = '同网省内' if agent_ip_info.get('province') == dst_ip_info.get('province') else '同网跨省'
-                else:
-                    source['flow_isp_type'] = '异网(未知)' if not dst_isp else f'异网({dst_isp})'
-                    
-                # 获取cacti流量图信息
-                cacti_data = sflow_cacti_data_map.get(int(config['relation_cacti_graph_id']),{})
-                logger.info(f"cacti_data: {cacti_data}")
-                
-                # 更新source信息
-                source.update({
-                    'flow_isp_info_src': src_ip_info,
-                    'flow_isp_info': dst_ip_info,
-                    'node': config['node'],
-                    'customer': config['costumer'],
-                    'sw_interface': config['switch'],
-                    'src_ip_region': f"{src_ip} {src_ip_info.get('province', '')}{src_ip_info.get('city', '')}",
-                    'dst_ip_region': f"{dst_ip} {dst_ip_info.get('province', '')}{dst_ip_info.get('city', '')}",
-                    'flow_direction': config['flow_direction'],
-                    'sum_traffic_in_max': cacti_data.get('traffic_in_max', 0),
-                    'sum_traffic_out_max': cacti_data.get('traffic_out_max', 0),
-                    
-                })
+                self.store_ipv4_info(db, ip, ip_long, self.region_by_table_id(db, region_id), pending[ip],
+                                     ip_info_cache)
+            ips = fallback_ips
+        # 落在已缓存 xdb 段内的地址
+        missing = []
+        for ip, ip_long in ips:
+            ip_info = self.ip_range_cache.get(ip_long)
+            if ip_info is None:
+                missing.append((ip, ip_long))
+            else:
+                self.store_ipv4_info(db, ip, ip_long, ip_info, pending[ip], ip_info_cache)
+        if not missing:
+            return
+        sips, eips, ptrs, lens = db.searcher.searchManySegments(array("I", [ip_long for _, ip_long in missing]))
+        for (ip, ip_long), sip, eip, data_ptr, data_len in zip(missing, sips, eips, ptrs, lens):
+            ip_info = self.region_by_ptr(db, data_ptr, data_len)
+            if data_ptr >= 0 and db is self.db:
+                self.ip_range_cache.set(sip, eip, ip_info)
+            self.store_ipv4_info(db, ip, ip_long, ip_info, pending[ip], ip_info_cache)
 
-                # if host_ip == "58.19.25.1" and interface == "69":
-                #     logger.warning(f"当前配置: {config}")
-                #     logger.warning(f"匹配到的的文档: {matching_docs}")
-                #     logger.warning(f"更新后的文档: {doc}")
-                new_docs.append(doc)
-        except Exception as e:
-            logger.error(f"rewrite_docs出错: {e}")
-        finally:
-            searcher.close()
-        return new_docs
+    def store_ipv4_info(self, db, ip, ip_long, ip_info, rewrite, ip_info_cache):
+        # 旧版本 xdb 上进行中的批次不写共享缓存，避免热更新后留下旧结果
+        if db is self.db:
+            self.ip_cache.set(ip_long, ip_info)
+        ip_info_cache[ip] = self.rewrite_ipinfo(ip_long, ip_info) if rewrite else ip_info
 
-    def rewrite_docs_v2(self, docs):
+    def cache_stats(self):
         """
-        重写elasticsearch查询结果，添加IP归属地信息
+        :return: 共享IP缓存、xdb 段区间缓存和 IPv6 查询缓存的命中统计
         """
-        # 默认情况下agent_ip和host_ip是一样的，但在三线情况下可能不同，所以以agent_ip为准
-        searcher = XdbSearcher(contentBuff=self.cb)
-        host_ip_index_config_map = self.read_config_data_v2()
-        new_docs = []
-        # IP信息缓存
-        ip_info_cache = {}
-        try:
-            for doc in docs:
-                source = doc['_source']
-                host_ip = source['host'].get('ip')
-                local_ip = source.get('in_dst')
-                remote_ip = source.get('in_src')
-                config = host_ip_index_config_map.get(f"{host_ip}",{})
-                if not all([local_ip, remote_ip, host_ip]):
-                    # logger.warning(f"本机IP: {host_ip} 目标IP: {local_ip} 源IP: {remote_ip} Doc: {doc} 配置: {config}")
+        return {
+            'ip_cache': self.ip_cache.stats(),
+            'ip_range_cache': self.ip_range_cache.stats(),
+            'ipv6_cache': self.ipv6_cache.stats(),
+        }
+
+    def search_ipv6_regions(self, ips, provisional=None):
+        """
+        查询IPv6地址归属：优先使用本地区间索引和跨批次缓存，MySQL 只在开启回退时查询剩余地址
+
+        :param provisional: 传入 set 时不等待 MySQL，剩余地址先返回"未知"并加入该集合
+        :return: {ip: Region}
+        """
+        regions = {}
+        missing = []
+        for ip in ips:
+            fields = self.ipv6_index.search(ip) if self.ipv6_index is not None else None
+            if fields is not None:
+                regions[ip] = self.ipv6_region(fields)
+                continue
+            region = self.ipv6_cache.get(ip)
+            if region is not None:
+                regions[ip] = region
+            else:
+                missing.append(ip)
+        if missing and self.ipv6_mysql_fallback and provisional is None:
+            try:
+                regions.update(self.search_ipv6_mysql(missing))
+            except mysql.connector.Error as e:
+                # MySQL 不可用时记为"未知"并按查不到的有效期缓存，不让整页补全失败
+                logger.error(f"IPv6 查询出错，{len(missing)} 个地址暂记为未知: {e}")
+                unknown = self.resolve_ip_region(None, ipv6=True)
+                for ip in missing:
+                    regions[ip] = unknown
+                    self.ipv6_cache.set(ip, unknown, ttl=self.ipv6_negative_ttl)
+            return regions
+        for ip in missing:
+            regions[ip] = self.resolve_ip_region(None, ipv6=True)
+            if self.ipv6_mysql_fallback:
+                provisional.add(ip)
+        return regions
+
+    def search_ipv6_mysql(self, ips):
+        results = self.ipv6_searcher.search_many(ips)
+        regions = {}
+        for ip in ips:
+            row = results.get(ip)
+            region = regions[ip] = self.resolve_ip_region(row, ipv6=True)
+            self.ipv6_cache.set(ip, region, ttl=self.ipv6_cache_ttl if row else self.ipv6_negative_ttl)
+        return regions
+
+    def prefetch_ipv6_info(self, ips, ip_info_cache, provisional=None):
+        """
+        一页文档中的IPv6地址合并查询，结果写入 ip_info_cache
+        """
+        ips = [ip for ip in ips if ip not in ip_info_cache]
+        if ips:
+            ip_info_cache.update(self.search_ipv6_regions(ips, provisional))
+
+    def defer_ipv6_updates(self, deferred):
+        """
+        主批次写入ES后登记需要补充更新的文档，新出现的地址交给后台线程解析
+
+        :param deferred: Enricher.bulk_actions 收集的 (ip, 索引, 文档ID, 'src'/'dst', agent_ip_info)
+        """
+        new_ips = []
+        with self.ipv6_deferred_lock:
+            for ip, *ref in deferred:
+                refs = self.ipv6_waiting.get(ip)
+                if refs is None:
+                    refs = self.ipv6_waiting[ip] = []
+                    new_ips.append(ip)
+                refs.append(ref)
+        if new_ips:
+            self.ipv6_queue.put(new_ips)
+
+    def resolve_deferred_ipv6(self):
+        """
+        后台解析延迟的IPv6地址，解析出结果后通过 deferred_update_handler 补发部分更新
+        """
+        unknown = self.resolve_ip_region(None, ipv6=True)
+        while True:
+            ips = self.ipv6_queue.get()
+            while len(ips) < 1000:
+                try:
+                    ips += self.ipv6_queue.get_nowait()
+                except queue.Empty:
+                    break
+            try:
+                regions = self.search_ipv6_mysql(ips)
+            except Exception as e:
+                self.retry_deferred_ipv6(ips, e)
+                continue
+            with self.ipv6_deferred_lock:
+                refs_by_ip = {ip: self.ipv6_waiting.pop(ip, []) for ip in ips}
+                for ip in ips:
+                    self.ipv6_attempts.pop(ip, None)
+
+            updates = []
+            for ip, refs in refs_by_ip.items():
+                region = regions.get(ip)
+                if region is None or region == unknown:
                     continue
-                if local_ip not in ip_info_cache:
-                    result = searcher.search(local_ip)
-                    ip_info_cache[local_ip] = self.resolve_ip_region(result)
-                local_ip_info = ip_info_cache[local_ip]
-
-                # 使用缓存获取IP信息
-                is_ipv4 = self.is_ipv4(remote_ip)
-                source['ipType'] = "ipv4" if is_ipv4 else "ipv6"
-                # 使用缓存获取IP信息
-                is_ipv4 = self.is_ipv4(local_ip)
-                # 获取源IP和目标IP信息
-                for ip in (local_ip, remote_ip):
-                    if ip not in ip_info_cache:
-                        if is_ipv4:
-                            result = searcher.search(ip)
-                            ip_info_cache[ip] = self.rewrite_ipinfo(ip, self.resolve_ip_region(result))
-                        # else:
-                        #     result = ipv6_search(ip)
-                        #     ip_info_cache[ip] = self.resolve_ip_region(result, ipv6=True)
-                
-                local_ip_info = ip_info_cache[local_ip]
-                remote_ip_info = ip_info_cache[remote_ip]
-                
-                # 处理ISP信息
-                local_isp = local_ip_info.get('isp').replace('中国', '')
-                remote_isp = remote_ip_info.get('isp').replace('中国', '')
-                
-                # 设置流量类型
-                # if local_isp != "未知" and remote_isp != "未知" and local_isp == remote_isp:
-                #     source['flow_isp_type'] = '同网省内' if local_ip_info.get('province') == remote_ip_info.get('province') else '同网跨省'
-                # else:
-                #     source['flow_isp_type'] = '异网(未知)' if not dst_isp else f'异网({dst_isp})'
-                
-                # 更新source信息
-                source.update({
-                    'host_name': config.get('host_name', '未知'),
-                    'node': config.get('node', '未知'),
-                    'customer': config.get('costumer', '未知'),
-                    'interface': config.get('interface', '未知'),
-                    'local_ip_info': local_ip_info,
-                    'remote_ip_info': remote_ip_info,
-                    'local_ip_region': f"{local_ip_info.get('province', '')}{local_ip_info.get('city', '')}",
-                    'local_ip_region_full': f"{local_ip} {local_ip_info.get('province', '')}{local_ip_info.get('city', '')}",
-                    'remote_ip_region': f"{remote_ip_info.get('province', '')}{remote_ip_info.get('city', '')}",
-                    'remote_ip_region_full': f"{remote_ip} {remote_ip_info.get('province', '')}{remote_ip_info.get('city', '')}",
-                    'local_ip_isp': local_isp,
-                    'remote_ip_isp': remote_isp,
-                })
+                region_str = f"{ip} {region.get('province', '')}{region.get('city', '')}"
+                for index, doc_id, role, agent_ip_info in refs:
+                    if role == 'src':
+                        fields = {'flow_isp_info_src': region, 'src_ip_region': region_str}
+                    else:
+                        fields = {
+                            'flow_isp_info': region,
+                            'dst_ip_region': region_str,
+                            'flow_isp_type': self.flow_isp_type(agent_ip_info, region),
+                        }
+                    updates.append((index, doc_id, fields))
+            if updates and self.deferred_update_handler is not None:
+                try:
+                    self.deferred_update_handler(updates)
+                except Exception as e:
+                    logger.error(f"IPv6 延迟解析补充更新出错: {e}")
 
-                # if host_ip == "58.19.25.1" and interface == "69":
-                #     logger.warning(f"当前配置: {config}")
-                #     logger.warning(f"匹配到的的文档: {matching_docs}")
-                #     logger.warning(f"更新后的文档: {doc}")
-                new_docs.append(doc)
-        except Exception as e:
-            logger.error(f"rewrite_docs出错: {e}")
-        finally:
-            searcher.close()
-        return new_docs
-    
-    def rewrite_docs_v3(self, docs):
-        """
-        重写elasticsearch查询结果，添加IP归属地信息
-        """
-        searcher = XdbSearcher(contentBuff=self.cb)
-        host_ip_index_config_map = self.read_config_data_v2()
-        new_docs = []
-        # IP信息缓存
-        ip_info_cache = {}
-        try:
-            for doc in docs:
-                source = doc['_source']
-                host_ip = source['host'].get('ip')
-                local_ip = source.get('source_ip')
-                config = host_ip_index_config_map.get(f"{host_ip}",{})
-                if not all([local_ip, host_ip]):
-                    # logger.warning(f"本机IP: {host_ip} 目标IP: {local_ip} 源IP: {remote_ip} Doc: {doc} 配置: {config}")
+    def retry_deferred_ipv6(self, ips, error):
+        """
+        MySQL 查询失败：相关文档的登记保留，地址退避后重新排队；重试用尽的地址放弃，文档保持"未知"
+        """
+        retry = []
+        dropped = 0
+        attempt = 0
+        with self.ipv6_deferred_lock:
+            for ip in ips:
+                count = self.ipv6_attempts.get(ip, 0) + 1
+                if count > self.ipv6_deferred_retries:
+                    self.ipv6_attempts.pop(ip, None)
+                    dropped += len(self.ipv6_waiting.pop(ip, []))
                     continue
-                if local_ip not in ip_info_cache:
-                    result = searcher.search(local_ip)
-                    ip_info_cache[local_ip] = self.resolve_ip_region(result)
-                local_ip_info = ip_info_cache[local_ip]
-
-                # 使用缓存获取IP信息
-                is_ipv4 = self.is_ipv4(local_ip)
-                source['ipType'] = "ipv4" if is_ipv4 else "ipv6"
-                # 使用缓存获取IP信息
-                is_ipv4 = self.is_ipv4(local_ip)
-                # 获取源IP和目标IP信息
-                for ip in (local_ip, host_ip):
-                    if ip not in ip_info_cache:
-                        if is_ipv4:
-                            result = searcher.search(ip)
-                            ip_info_cache[ip] = self.rewrite_ipinfo(ip, self.resolve_ip_region(result))
-                        # else:
-                        #     result = ipv6_search(ip)
-                        #     ip_info_cache[ip] = self.resolve_ip_region(result, ipv6=True)
-                
-                local_ip_info = ip_info_cache[local_ip]                
-                # 处理ISP信息
-                local_isp = local_ip_info.get('isp').replace('中国', '')
-                
-                # 设置流量类型
-                # if local_isp != "未知" and remote_isp != "未知" and local_isp == remote_isp:
-                #     source['flow_isp_type'] = '同网省内' if local_ip_info.get('province') == remote_ip_info.get('province') else '同网跨省'
-                # else:
-                #     source['flow_isp_type'] = '异网(未知)' if not dst_isp else f'异网({dst_isp})'
-                
-                # 更新source信息
-                source.update({
-                    'host_name': config.get('host_name', '未知'),
-                    'node': config.get('node', '未知'),
-                    'customer': config.get('costumer', '未知'),
-                    'interface': config.get('interface', '未知'),
-                    'local_ip_info': local_ip_info,
-                    'local_ip_region': f"{local_ip_info.get('province', '')}{local_ip_info.get('city', '')}",
-                    'local_ip_region_full': f"{local_ip} {local_ip_info.get('province', '')}{local_ip_info.get('city', '')}",
-                    'local_ip_isp': local_isp,
-                })
+                self.ipv6_attempts[ip] = count
+                attempt = max(attempt, count)
+                retry.append(ip)
+        logger.error(f"IPv6 延迟解析出错，{len(retry)} 个地址稍后重试，"
+                     f"{dropped} 个文档重试用尽保持未知: {error}")
+        if retry:
+            time.sleep(min(self.ipv6_deferred_max_backoff, self.ipv6_deferred_backoff * 2 ** (attempt - 1)))
+            self.ipv6_queue.put(retry)
 
-                new_docs.append(doc)
-        except Exception as e:
-            logger.error(f"rewrite_docs出错: {e}")
-        finally:
-            searcher.close()
-        return new_docs
\ No newline at end of file
+    def enrichment_templates(self, db):
+        """
+        为 config_data.json 中的每个接口预先解析 agent_ip 归属地并取出配置和 cacti 字段
+        接口配置、cacti 数据或 xdb 版本变化后的第一个批次重建，其余批次直接复用
+
+        :return: {"host_ip_ifindex": EnrichmentTemplate}，配置不完整的接口不在其中
+        """
+        config_map = self.read_config_data()
+        cacti_map = self.read_sflow_cacti_data()
+        key, templates = self.templates
+        if key[0] is config_map and key[1] is cacti_map and key[2] is db:
+            return templates
+        with self.templates_lock:
+            key, templates = self.templates
+            if key[0] is config_map and key[1] is cacti_map and key[2] is db:
+                return templates
+            start = time.time()
+            agent_ip_info = {}
+            pending = {config.get('agent_ip'): True for config in config_map.values() if config.get('agent_ip')}
+            self.prefetch_ipv4_info(db, pending, agent_ip_info)
+            templates = {}
+            for lookup_key, config in config_map.items():
+                agent_ip = config.get('agent_ip')
+                if agent_ip not in agent_ip_info:
+                    continue
+                try:
+                    cacti_data = cacti_map.get(int(config['relation_cacti_graph_id']), {})
+                    fields = {
+                        'node': config['node'],
+                        'customer': config['costumer'],
+                        'sw_interface': config['switch'],
+                        'flow_direction': config['flow_direction'],
+                        'sum_traffic_in_max': cacti_data.get('traffic_in_max', 0),
+                        'sum_traffic_out_max': cacti_data.get('traffic_out_max', 0),
+                    }
+                except (KeyError, TypeError, ValueError) as e:
+                    logger.error(f"接口配置 {lookup_key} 不完整: {e}")
+                    continue
+                templates[lookup_key] = EnrichmentTemplate(agent_ip, agent_ip_info[agent_ip], fields)
+            self.templates = ((config_map, cacti_map, db), templates)
+            logger.warning(f"已生成 {len(templates)} 个接口模板，耗时：{round(time.time() - start, 3)}s")
+            return templates
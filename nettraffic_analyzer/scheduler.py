@@ -0,0 +1,104 @@
+"""
+按积压和查询耗时调整轮询间隔与每页条数
+
+追不上时缩短间隔、在查询耗时允许的范围内加大每页条数；空轮询时逐步拉长间隔；
+ES 返回 429 或超时时加倍间隔并缩小每页条数。
+"""
+import threading
+from datetime import datetime, timezone
+
+from elasticsearch import ApiError, ConnectionTimeout
+
+
+class PollScheduler:
+    """
+    :param min_interval: 最短轮询间隔(秒)
+    :param max_interval: 空闲时的最长轮询间隔(秒)
+    :param max_backoff: ES 过载时的最长轮询间隔(秒)
+    :param min_page_size: 每页最少条数
+    :param max_page_size: 每页最多条数
+    :param page_size: 初始每页条数
+    :param target_latency: 单页查询的期望耗时(秒)，超过两倍时缩小每页条数
+    :param lag_target: 积压超过该秒数时按最短间隔轮询
+    """
+
+    def __init__(self, min_interval=0.5, max_interval=10, max_backoff=60, min_page_size=1000,
+                 max_page_size=10000, page_size=10000, target_latency=1.0, lag_target=30):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_backoff = max_backoff
+        self.min_page_size = min_page_size
+        self.max_page_size = max_page_size
+        self.target_latency = target_latency
+        self.lag_target = lag_target
+        self.interval = min_interval
+        self.page_size = max(min_page_size, min(page_size, max_page_size))
+        # 单页查询耗时的指数移动平均
+        self.fetch_latency = None
+        # 当前时间与最新已写入文档时间戳之差(秒)
+        self.lag = None
+        self.overloads = 0
+        self.lock = threading.Lock()
+
+    def observe_page(self, count, latency):
+        """
+        :param count: 这一页的文档数
+        :param latency: 这一页的查询耗时(秒)
+        """
+        with self.lock:
+            if self.fetch_latency is None:
+                self.fetch_latency = latency
+            else:
+                self.fetch_latency = 0.8 * self.fetch_latency + 0.2 * latency
+            if self.fetch_latency > 2 * self.target_latency:
+                self.page_size = max(self.min_page_size, self.page_size // 2)
+            elif count >= self.page_size and self.fetch_latency < self.target_latency:
+                # 取满一页且查询不慢，说明还有积压
+                self.page_size = min(self.max_page_size, self.page_size * 2)
+
+    def observe_round(self, progressed, newest_timestamp=None):
+        """
+        一轮查询结束
+
+        :param progressed: 是否取到了新文档
+        :param newest_timestamp: 最新已写入文档的时间戳(datetime)
+        """
+        with self.lock:
+            if newest_timestamp is not None:
+                self.lag = max(0.0, (datetime.now(timezone.utc) - newest_timestamp).total_seconds())
+            if not progressed:
+                self.interval = min(self.max_interval, self.interval * 1.5)
+            elif self.lag is not None and self.lag > self.lag_target:
+                self.interval = self.min_interval
+            else:
+                self.interval = max(self.min_interval, self.interval / 2)
+
+    def observe_error(self, error):
+        """
+        查询出错，ES 过载(429/超时)时退避
+        """
+        if not self.is_overload(error):
+            return
+        with self.lock:
+            self.overloads += 1
+            self.interval = min(self.max_backoff, max(self.interval * 2, self.min_interval * 2))
+            self.page_size = max(self.min_page_size, self.page_size // 2)
+
+    @staticmethod
+    def is_overload(error):
+        if isinstance(error, ConnectionTimeout):
+            return True
+        return isinstance(error, ApiError) and error.status_code == 429
+
+    def stats(self):
+        """
+        :return: 积压、轮询间隔、每页条数、单页查询耗时和过载次数
+        """
+        with self.lock:
+            return {
+                'lag': round(self.lag, 3) if self.lag is not None else None,
+                'interval': round(self.interval, 3),
+                'page_size': self.page_size,
+                'fetch_latency': round(self.fetch_latency, 3) if self.fetch_latency is not None else None,
+                'overloads': self.overloads,
+            }
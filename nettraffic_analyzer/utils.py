@@ -6,8 +6,10 @@
 import os
 import logging
 import socket
+import threading
 import time
 import mysql.connector
+import mysql.connector.pooling
 import psutil
 import platform
 import requests
@@ -87,47 +89,95 @@ def get_ifname_by_ip(ip_address):
     return None
 
 
-def get_elk_config():
-    url = "http://localhost:8000/elk/config"
+def get_elk_config(config_cache=None, url="http://localhost:8000/elk/config", interval=10):
+    """
+    轮询配置接口，带 If-None-Match 请求，内容未变化时服务端返回 304
+
+    :param config_cache: 可选的 JsonFileCache，拿到新配置后更新其快照
+    """
+    etag = None
     while True:
         global config_data
         try:
-            response = requests.get(url)
+            headers = {'If-None-Match': etag} if etag else {}
+            response = requests.get(url, headers=headers, timeout=interval)
             if response.status_code == 200:
                 config_data = response.json()
+                etag = response.headers.get('ETag')
+                if config_cache is not None:
+                    config_cache.update(response.content, url)
             else:
                 pass
         except requests.exceptions.RequestException as e:
             pass
-        time.sleep(10)
-
-
-def ipv6_search(ipv6_address, db_host, db_user, db_password, db_database):
-    connection = mysql.connector.connect(
-        host=db_host,
-        user=db_user,
-        password=db_password,
-        database=db_database
-    )
-    cursor = connection.cursor()
-    sql = """
-        SELECT * 
-        FROM ipv6_china_mainland
-        WHERE 
-            ip_dig_min_bin <= INET6_ATON(%s) 
-            AND ip_dig_max_bin >= INET6_ATON(%s)
-        ORDER BY ip_dig_min_bin DESC 
-        LIMIT 1;
+        time.sleep(interval)
+
+
+class Ipv6Searcher:
+    """
+    ipv6_china_mainland 查询：连接池复用连接，一批地址合并成少量几次查询
+    """
+    sql_part = """
+        (SELECT %s AS query_ip, t.*
+        FROM ipv6_china_mainland t
+        WHERE
+            t.ip_dig_min_bin <= INET6_ATON(%s)
+            AND t.ip_dig_max_bin >= INET6_ATON(%s)
+        ORDER BY t.ip_dig_min_bin DESC
+        LIMIT 1)
         """
 
-    cursor.execute(sql, (ipv6_address, ipv6_address))
-
-    result = cursor.fetchone()
-
-    cursor.close()
-    connection.close()
+    def __init__(self, db_host, db_user, db_password, db_database, pool_size=5, chunk_size=200):
+        self.db_config = {
+            'host': db_host,
+            'user': db_user,
+            'password': db_password,
+            'database': db_database,
+        }
+        self.pool_size = pool_size
+        self.chunk_size = chunk_size
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        # 连接池满时 get_connection 直接报错，用信号量让调用线程排队等待
+        self.slots = threading.BoundedSemaphore(pool_size)
+
+    def get_pool(self):
+        # 首次查询时才建立连接池，MySQL 不可用不影响启动
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = mysql.connector.pooling.MySQLConnectionPool(
+                    pool_name="ipv6_search", pool_size=self.pool_size, **self.db_config)
+            return self.pool
+
+    def search(self, ipv6_address):
+        return self.search_many([ipv6_address]).get(ipv6_address)
+
+    def search_many(self, ipv6_addresses):
+        """
+        批量查询IPv6地址归属
 
-    return result
+        :param ipv6_addresses: IPv6 地址列表
+        :return: {地址: ipv6_china_mainland 整行}，查不到的地址不在结果中
+        """
+        addresses = list(dict.fromkeys(ipv6_addresses))
+        results = {}
+        if not addresses:
+            return results
+        with self.slots:
+            connection = self.get_pool().get_connection()
+            try:
+                cursor = connection.cursor()
+                for i in range(0, len(addresses), self.chunk_size):
+                    chunk = addresses[i:i + self.chunk_size]
+                    sql = " UNION ALL ".join([self.sql_part] * len(chunk))
+                    params = [value for address in chunk for value in (address, address, address)]
+                    cursor.execute(sql, params)
+                    for row in cursor.fetchall():
+                        results[row[0]] = row[1:]
+                cursor.close()
+            finally:
+                connection.close()
+        return results
 
 
 banner = f"""启动NettrafficAnalyzer_for_ELK程序...\n
@@ -5,10 +5,19 @@
 #  Copyright © 2022年 luckydog. All rights reserved.
 #
 
+import mmap
+import os
 import socket
 import struct
 import io
 import sys
+from array import array
+from bisect import bisect_right
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 # xdb默认参数
@@ -18,14 +27,32 @@ VectorIndexCols = 256
 VectorIndexSize = 8
 SegmentIndexSize = 14
 
+# 段索引记录: 起始IP(4) | 结束IP(4) | 数据长度(2) | 数据指针(4)
+SegmentIndexStruct = struct.Struct("<IIHI")
+SegmentIndexDtype = np.dtype([
+    ("sip", "<u4"), ("eip", "<u4"), ("dataLen", "<u2"), ("dataPtr", "<u4")
+]) if np is not None else None
+
+# 段索引缓存文件(china.xdb.seg): 魔数 | 版本 | 段数 | xdb文件大小 | xdb头部前16字节
+SegmentCacheMagic = b"XSEG"
+SegmentCacheVersion = 1
+SegmentCacheHeader = struct.Struct("<4sIIQ16s")
+
 
 class XdbSearcher(object):
     __f = None
 
     # the minimal memory allocation.
     vectorIndex = None
-    # 整个读取xdb，保存在内存中
+    # 整个读取xdb，保存在内存中(bytes 或只读 mmap)
     contentBuff = None
+    # contentBuff 的零拷贝视图
+    contentView = None
+    # 预解码的段索引列 array('I'/'H')，由 loadSegmentIndex 构建
+    segSip = None
+    segEip = None
+    segDataLen = None
+    segDataPtr = None
 
     @staticmethod
     def loadVectorIndexFromFile(dbfile):
@@ -49,6 +76,18 @@ class XdbSearcher(object):
         except IOError as e:
             print("[Error]: %s" % e)
 
+    @staticmethod
+    def loadContentMmapFromFile(dbfile):
+        """
+        " map the whole xdb file read-only, processes mapping the same file
+        " share one page-cache copy and nothing is read up front
+        """
+        try:
+            with io.open(dbfile, "rb") as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, ValueError) as e:
+            print("[Error]: %s" % e)
+
     def __init__(self, dbfile=None, vectorIndex=None, contentBuff=None):
         self.initDatabase(dbfile, vectorIndex, contentBuff)
 
@@ -64,6 +103,38 @@ class XdbSearcher(object):
         return self.searchByIPLong(ip)
          
     def searchByIPLong(self, ip):
+        dataPtr, dataLen = self.searchPtrByIPLong(ip)
+
+        # empty match interception
+        if dataPtr < 0:
+            return ""
+
+        return self.readString(dataPtr, dataLen)
+
+    def searchPtr(self, ip):
+        if isinstance(ip, str):
+            ip = int(ip) if ip.isdigit() else self.ip2long(ip)
+        return self.searchPtrByIPLong(ip)
+
+    def searchPtrByIPLong(self, ip):
+        """
+        " locate the region record of ip without decoding it
+        " return: (dataPtr, dataLen), dataPtr is -1 for no match
+        """
+        return self.searchSegmentByIPLong(ip)[2:]
+
+    def searchSegmentByIPLong(self, ip):
+        """
+        " like searchPtrByIPLong, plus the ip range of the matched segment
+        " return: (startIp, endIp, dataPtr, dataLen), all -1 for no match
+        """
+        # use the pre-decoded segment index if loaded
+        if self.segSip is not None:
+            i = bisect_right(self.segSip, ip) - 1
+            if i < 0 or ip > self.segEip[i]:
+                return -1, -1, -1, -1
+            return self.segSip[i], self.segEip[i], self.segDataPtr[i], self.segDataLen[i]
+
         # locate the segment index block based on the vector index
         sPtr = ePtr = 0
         il0 = (int)((ip >> 24) & 0xFF)
@@ -83,33 +154,189 @@ class XdbSearcher(object):
             ePtr = self.getLong(buffer_ptr, 4)
 
         # binary search the segment index block to get the region info
-        dataLen = dataPtr = int(-1)
         l = int(0)
         h = int((ePtr - sPtr) / SegmentIndexSize)
         while l <= h:
             m = int((l + h) >> 1)
             p = int(sPtr + m * SegmentIndexSize)
             # read the segment index
-            buffer_sip = self.readBuffer(p, SegmentIndexSize)
-            sip = self.getLong(buffer_sip, 0)
+            sip, eip, segLen, segPtr = self.readSegment(p)
             if ip < sip:
                 h = m - 1
+            elif ip > eip:
+                l = m + 1
             else:
-                eip = self.getLong(buffer_sip, 4)
-                if ip > eip:
-                    l = m + 1
+                return sip, eip, segPtr, segLen
+
+        return -1, -1, -1, -1
+
+    def searchMany(self, ips):
+        """
+        " batch search a page of IPv4 addresses at once
+        " param: ips, list of ip strings / ints, or an uint32 array
+        " return: list of region strings, "" for no match or invalid ip
+        """
+        ptrs, lens = self.searchManyPtr(ips)
+        # 同一区域只解码一次
+        regions = {-1: ""}
+        result = []
+        for ptr, length in zip(ptrs, lens):
+            region = regions.get(ptr)
+            if region is None:
+                region = regions[ptr] = self.readString(ptr, length)
+            result.append(region)
+        return result
+
+    def searchManyPtr(self, ips):
+        """
+        " batch version of searchPtr
+        " return: (dataPtr list, dataLen list), dataPtr is -1 for no match or invalid ip
+        """
+        return self.searchManySegments(ips)[2:]
+
+    def searchManySegments(self, ips):
+        """
+        " batch version of searchSegmentByIPLong
+        " return: (startIp list, endIp list, dataPtr list, dataLen list), all -1 for no match or invalid ip
+        """
+        if self.segSip is None and self.contentBuff is not None:
+            self.loadSegmentIndex()
+        if np is None or self.segSip is None:
+            located = [self._searchSegmentOrEmpty(ip) for ip in ips]
+            return tuple([segment[column] for segment in located] for column in range(4))
+
+        ip_arr, valid = self.toIPLongArray(ips)
+        seg_sip = np.frombuffer(self.segSip, dtype=np.uint32)
+        seg_eip = np.frombuffer(self.segEip, dtype=np.uint32)
+        seg_ptr = np.frombuffer(self.segDataPtr, dtype=np.uint32)
+        seg_len = np.frombuffer(self.segDataLen, dtype=np.uint16)
+
+        # 所有段按起始IP全局有序，等价于向量索引定位后再做段内二分
+        idx = np.searchsorted(seg_sip, ip_arr, side="right") - 1
+        np.clip(idx, 0, None, out=idx)
+        found = valid & (ip_arr >= seg_sip[idx]) & (ip_arr <= seg_eip[idx])
+        return tuple(
+            np.where(found, column[idx].astype(np.int64), -1).tolist()
+            for column in (seg_sip, seg_eip, seg_ptr, seg_len)
+        )
+
+    def loadSegmentIndex(self, cacheFile=None):
+        """
+        " decode the whole segment index into typed arrays once, searches
+        " then become a single bisect over integers
+        " param: cacheFile, optional sidecar file (e.g. china.xdb.seg) to
+        "        read the arrays from, written after a fresh decode
+        """
+        header = self.readBuffer(0, 16)
+        startPtr = self.getLong(header, 8)
+        endPtr = self.getLong(header, 12)
+        count = (endPtr - startPtr) // SegmentIndexSize + 1
+        dbSize = len(self.contentBuff) if self.contentBuff is not None else os.fstat(self.__f.fileno()).st_size
+
+        columns = None
+        if cacheFile is not None:
+            columns = self.loadSegmentCache(cacheFile, count, dbSize, header)
+        if columns is None:
+            columns = self.decodeSegmentIndex(startPtr, count)
+            if cacheFile is not None:
+                self.saveSegmentCache(cacheFile, columns, dbSize, header)
+
+        sip, eip, dataLen, dataPtr = columns
+        self.segEip = eip
+        self.segDataLen = dataLen
+        self.segDataPtr = dataPtr
+        # segSip 最后赋值，其它线程看到它时其余列已就绪
+        self.segSip = sip
+
+    def decodeSegmentIndex(self, startPtr, count):
+        sip, eip, dataLen, dataPtr = array("I"), array("I"), array("H"), array("I")
+        buffer = self.readBuffer(startPtr, count * SegmentIndexSize)
+        if np is not None:
+            segments = np.frombuffer(buffer, dtype=SegmentIndexDtype, count=count)
+            sip.frombytes(segments["sip"].tobytes())
+            eip.frombytes(segments["eip"].tobytes())
+            dataLen.frombytes(segments["dataLen"].tobytes())
+            dataPtr.frombytes(segments["dataPtr"].tobytes())
+        else:
+            for s, e, l, p in SegmentIndexStruct.iter_unpack(buffer):
+                sip.append(s)
+                eip.append(e)
+                dataLen.append(l)
+                dataPtr.append(p)
+        return sip, eip, dataLen, dataPtr
+
+    @staticmethod
+    def loadSegmentCache(cacheFile, count, dbSize, dbHeader):
+        try:
+            with io.open(cacheFile, "rb") as f:
+                magic, version, cachedCount, cachedSize, cachedHeader = \
+                    SegmentCacheHeader.unpack(f.read(SegmentCacheHeader.size))
+                if (magic, version, cachedCount, cachedSize, cachedHeader) != \
+                        (SegmentCacheMagic, SegmentCacheVersion, count, dbSize, bytes(dbHeader)):
+                    return None
+                columns = array("I"), array("I"), array("H"), array("I")
+                for column in columns:
+                    column.fromfile(f, count)
+                return columns
+        except (IOError, EOFError, struct.error):
+            return None
+
+    @staticmethod
+    def saveSegmentCache(cacheFile, columns, dbSize, dbHeader):
+        tmpFile = "%s.%d.tmp" % (cacheFile, os.getpid())
+        try:
+            with io.open(tmpFile, "wb") as f:
+                f.write(SegmentCacheHeader.pack(
+                    SegmentCacheMagic, SegmentCacheVersion, len(columns[0]), dbSize, bytes(dbHeader)))
+                for column in columns:
+                    column.tofile(f)
+            os.replace(tmpFile, cacheFile)
+        except IOError as e:
+            print("[Error]: %s" % e)
+
+    def toIPLongArray(self, ips):
+        """
+        " convert ips to an uint32 array and a mask of the valid entries
+        """
+        if isinstance(ips, np.ndarray) and ips.dtype.kind in "ui":
+            ip_arr = ips.astype(np.uint32, copy=False)
+            return ip_arr, np.ones(len(ip_arr), dtype=bool)
+        if isinstance(ips, array) and ips.typecode == "I":
+            ip_arr = np.frombuffer(ips, dtype=np.uint32)
+            return ip_arr, np.ones(len(ip_arr), dtype=bool)
+
+        ip_arr = np.zeros(len(ips), dtype=np.uint32)
+        valid = np.ones(len(ips), dtype=bool)
+        for i, ip in enumerate(ips):
+            try:
+                if isinstance(ip, str):
+                    ip_arr[i] = int(ip) if ip.isdigit() else self.ip2long(ip)
                 else:
-                    dataLen = self.getInt2(buffer_sip, 8)
-                    dataPtr = self.getLong(buffer_sip, 10)
-                    break
+                    ip_arr[i] = ip
+            except (OSError, ValueError, OverflowError):
+                valid[i] = False
+        return ip_arr, valid
 
-        # empty match interception
-        if dataPtr < 0:
-            return ""
+    def _searchSegmentOrEmpty(self, ip):
+        try:
+            if isinstance(ip, str):
+                ip = int(ip) if ip.isdigit() else self.ip2long(ip)
+            return self.searchSegmentByIPLong(ip)
+        except (OSError, ValueError, struct.error):
+            return -1, -1, -1, -1
+
+    def readSegment(self, offset):
+        """
+        " decode one segment index record: (sip, eip, dataLen, dataPtr)
+        """
+        if self.contentBuff is not None:
+            return SegmentIndexStruct.unpack_from(self.contentBuff, offset)
+        return SegmentIndexStruct.unpack(self.readBuffer(offset, SegmentIndexSize))
 
-        buffer_string = self.readBuffer(dataPtr, dataLen)
-        return_string = buffer_string.decode("utf-8")
-        return return_string
+    def readString(self, offset, length):
+        if self.contentView is not None:
+            return str(self.contentView[offset:offset + length], "utf-8")
+        return self.readBuffer(offset, length).decode("utf-8")
 
     def readBuffer(self, offset, length):
         buffer = None
@@ -134,6 +361,7 @@ class XdbSearcher(object):
                 self.__f = None
                 self.vectorIndex = None
                 self.contentBuff = cb
+                self.contentView = memoryview(cb)
             else:
                 self.__f = io.open(dbfile, "rb")
                 self.vectorIndex = vi
@@ -156,8 +384,8 @@ class XdbSearcher(object):
         return True
 
     def getLong(self, b, offset):
-        if len(b[offset:offset + 4]) == 4:
-            return struct.unpack('I', b[offset:offset + 4])[0]
+        if 0 <= offset and offset + 4 <= len(b):
+            return struct.unpack_from('<I', b, offset)[0]
         return 0
 
     def getInt2(self, b, offset):
@@ -166,8 +394,12 @@ class XdbSearcher(object):
     def close(self):
         if self.__f is not None:
             self.__f.close()
+        if self.contentView is not None:
+            self.contentView.release()
         self.vectorIndex = None
         self.contentBuff = None
+        self.contentView = None
+        self.segSip = self.segEip = self.segDataLen = self.segDataPtr = None
 
 
 if __name__ == '__main__':
@@ -4,6 +4,7 @@
 # Copyright (c) <yuanzigsa@gmail.com>
 
 import json
+import signal
 from nettraffic_analyzer.es import Es, Es_v2, Es_v3
 from nettraffic_analyzer.utils import *
 
@@ -26,4 +27,6 @@ if __name__ == "__main__":
         # 使用sflow解析
         es = Es()
     logger.warning(f"开始运行，版本: {es.__class__.__name__}")
+    # 收到 SIGTERM 后停止取数，等在途记录写完、游标推进后退出
+    signal.signal(signal.SIGTERM, lambda signum, frame: es.stop())
     es.run()